@@ -0,0 +1,439 @@
+"""
+Benchmarks for l4d2_vpk_lib and the map_tools pipeline
+
+Usage:
+    python benchmark_vpk.py [--files N] [--sizes tiny|small|mixed] [--preload N]
+                            [--archive-size BYTES] [--repeat N] [--json PATH]
+                            [--no-pipeline] [vpk_path ...]
+
+Without paths a synthetic VPK is generated in a temporary directory. Every
+benchmark reports the best of --repeat runs, --json writes all results so
+runs can be compared.
+
+The FileProcessor stages (extract_archive, export_vpk_files, process_vpk,
+compress_output) need map_tools and therefore PyQt5, they are skipped when
+it cannot be imported.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from binascii import crc32
+
+import l4d2_vpk_lib as vpk
+
+# directories and extensions of a typical map pack
+DIRS = ["materials/models/props_%d" % i for i in range(40)] + \
+       ["models/props_%d" % i for i in range(20)] + \
+       ["sound/ambient/%d" % i for i in range(10)] + \
+       ["maps", "scripts/vscripts", "particles"]
+EXTS = ["vmt", "vtf", "mdl", "vvd", "vtx", "phy", "wav", "nut", "txt", "pcf"]
+
+SIZE_DISTRIBUTIONS = {
+    # 0-64 bytes, stresses the index
+    "tiny": lambda rnd: rnd.randint(0, 64),
+    # log-normal around 2 KB, mostly .vmt and scripts
+    "small": lambda rnd: min(int(rnd.lognormvariate(7.6, 1.0)), 2**20),
+    # log-normal around 16 KB with a long tail up to 8 MB, like textures and sounds
+    "mixed": lambda rnd: min(int(rnd.lognormvariate(9.7, 2.0)), 2**23),
+}
+
+
+def make_source_tree(folder, file_count, sizes="tiny", seed=0):
+    """
+    Writes file_count reproducible files under folder, returns the total size
+    """
+    rnd = random.Random(seed)
+    size_of = SIZE_DISTRIBUTIONS[sizes]
+    total = 0
+
+    for i in range(file_count):
+        rel = os.path.join(folder, rnd.choice(DIRS))
+        os.makedirs(rel, exist_ok=True)
+        data = rnd.randbytes(size_of(rnd))
+        with open(os.path.join(rel, "file_%06d.%s" % (i, rnd.choice(EXTS))), 'wb') as f:
+            f.write(data)
+        total += len(data)
+
+    return total
+
+
+def _write_preload_vpk(src, output, preload, max_archive_size=None):
+    """
+    Packs src like NewVPK.save, but keeps the first preload bytes of every
+    file in the tree. NewVPK never writes preload data
+    """
+    entries = {}
+    archives = [[]]
+    archive_sizes = [0]
+
+    for root, _, files in os.walk(src):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            head, body = data[:preload], data[preload:]
+            if max_archive_size and archive_sizes[-1] and archive_sizes[-1] + len(body) > max_archive_size:
+                archives.append([])
+                archive_sizes.append(0)
+
+            archive_index = len(archives) - 1 if max_archive_size else 0x7fff
+            rel = os.path.relpath(path, src).replace(os.sep, '/')
+            entries[rel] = (crc32(data) & 0xffffffff, head, archive_index, archive_sizes[-1], len(body))
+            archives[-1].append(body)
+            archive_sizes[-1] += len(body)
+
+    tree = vpk._pack_tree_entries(entries)
+    header = struct.pack("3I", 0x55aa1234, 1, len(tree))
+
+    if not max_archive_size:
+        with open(output, 'wb') as f:
+            f.write(header + tree)
+            f.writelines(archives[0])
+        return output
+
+    dir_path = output[:-4] + "_dir.vpk"
+    with open(dir_path, 'wb') as f:
+        f.write(header + tree)
+    for index, chunks in enumerate(archives):
+        with open(vpk._make_archive_path(dir_path, index), 'wb') as f:
+            f.writelines(chunks)
+    return dir_path
+
+
+def make_synthetic_vpk(folder, file_count, seed=0, sizes="tiny", preload=0, max_archive_size=None):
+    """
+    Writes file_count files under folder/src and packs them into
+    folder/synthetic.vpk (synthetic_dir.vpk and numbered archives with
+    max_archive_size). preload keeps up to that many bytes of every file in
+    the directory tree. Returns the path of the VPK to open
+    """
+    src = os.path.join(folder, "src")
+    make_source_tree(src, file_count, sizes, seed)
+
+    output = os.path.join(folder, "synthetic.vpk")
+    if preload:
+        return _write_preload_vpk(src, output, preload, max_archive_size)
+
+    return vpk.new(src).save(output, max_archive_size=max_archive_size)[0]
+
+
+def read_cstring(f, encoding='utf-8'):
+    buf = b''
+    for chunk in iter(lambda: f.read(64), b''):
+        pos = chunk.find(b'\x00')
+        if pos > -1:
+            buf += chunk[:pos]
+            f.seek(f.tell() - (len(chunk) - (pos + 1)))
+            break
+        buf += chunk
+
+    try:
+        return buf.decode(encoding, errors='strict')
+    except UnicodeDecodeError:
+        return ' '
+
+
+def read_index_iter_stream(pak):
+    """
+    The directory tree parser read_index_iter replaced, reading one cstring
+    at a time, yields the same (file_path, metadata) as pak.read_index_iter()
+    """
+    _sblank, _sempty, _sdot, _ssep = ((' ', '', '.', '/')
+                                      if pak.path_enc else
+                                      (b' ', b'', b'.', b'/'))
+
+    with pak.fopen(pak.vpk_path, 'rb') as f:
+        f.seek(pak.header_length)
+
+        while True:
+            if pak.version > 0 and f.tell() > pak.tree_length + pak.header_length:
+                raise ValueError("Error parsing index (out of bounds)")
+
+            ext = read_cstring(f, pak.path_enc)
+            if not ext:
+                break
+
+            while True:
+                path = read_cstring(f, pak.path_enc)
+                if not path:
+                    break
+                if path != _sblank:
+                    path = path + _ssep
+                else:
+                    path = _sempty
+
+                while True:
+                    name = read_cstring(f, pak.path_enc)
+                    if not name:
+                        break
+
+                    (crc32,
+                     preload_length,
+                     archive_index,
+                     archive_offset,
+                     file_length,
+                     suffix,
+                     ) = metadata = list(struct.unpack("IHHIIH", f.read(18)))
+
+                    if suffix != 0xffff:
+                        raise ValueError("Error while parsing index")
+
+                    if archive_index == 0x7fff:
+                        metadata[3] = pak.header_length + pak.tree_length + archive_offset
+
+                    metadata = (f.read(preload_length),) + tuple(metadata[:-1])
+
+                    yield path + name + _sdot + ext, metadata
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _report(name, seconds, byte_count=None, baseline=None):
+    line = "  %-28s %9.2f ms" % (name, seconds * 1000)
+    result = {"seconds": seconds}
+
+    if byte_count is not None:
+        result["mb_per_s"] = byte_count / 2**20 / max(seconds, 1e-9)
+        line += "  %8.1f MB/s" % result["mb_per_s"]
+    if baseline is not None:
+        result["speedup"] = baseline / max(seconds, 1e-9)
+        line += "  (x%.1f)" % result["speedup"]
+
+    print(line)
+    return result
+
+
+def bench_read_index(vpk_path, repeat):
+    pak = vpk.open(vpk_path)
+
+    fast = dict(pak.read_index_iter())
+    stream = dict(read_index_iter_stream(pak))
+    if fast != stream:
+        raise AssertionError("read_index_iter and read_index_iter_stream disagree on %s" % vpk_path)
+
+    t_stream = timeit(lambda: sum(1 for _ in read_index_iter_stream(pak)), repeat)
+    t_fast = timeit(lambda: sum(1 for _ in pak.read_index_iter()), repeat)
+    t_lazy = timeit(lambda: vpk.open(vpk_path, lazy_preload=True).read_index(), repeat)
+
+    return {
+        "read_index_iter_stream": _report("read_index_iter_stream", t_stream),
+        "read_index_iter": _report("read_index_iter", t_fast, baseline=t_stream),
+        "read_index_lazy_preload": _report("read_index(lazy_preload)", t_lazy, baseline=t_stream),
+    }
+
+
+def bench_read(vpk_path, repeat, byte_count):
+    results = {}
+
+    for name, kwargs in (("read", {}), ("read_mmap", {"use_mmap": True})):
+        with vpk.open(vpk_path, **kwargs) as pak:
+            pak.read_index()
+
+            def read_all():
+                for path in pak:
+                    with pak.get_file(path) as f:
+                        f.read()
+
+            results[name] = _report("get_file+%s" % name, timeit(read_all, repeat), byte_count)
+
+    return results
+
+
+def bench_verify(vpk_path, repeat, byte_count):
+    with vpk.open(vpk_path) as pak:
+        pak.read_index()
+
+        def verify_each():
+            for path in pak:
+                with pak.get_file(path) as f:
+                    if not f.verify():
+                        raise AssertionError("%s failed verification" % path)
+
+        return {
+            "VPKFile.verify": _report("VPKFile.verify", timeit(verify_each, repeat), byte_count),
+            "verify_all": _report("verify_all", timeit(pak.verify_all, repeat), byte_count),
+        }
+
+
+def bench_extract(vpk_path, repeat, byte_count, folder):
+    dest = os.path.join(folder, "extract")
+
+    def extract():
+        shutil.rmtree(dest, ignore_errors=True)
+        with vpk.open(vpk_path) as pak:
+            pak.extract_all(dest)
+
+    return {"extract_all": _report("extract_all", timeit(extract, repeat), byte_count)}
+
+
+def bench_new_vpk(src, repeat, byte_count, folder):
+    output = os.path.join(folder, "resaved.vpk")
+    results = {"read_dir": _report("NewVPK.read_dir", timeit(lambda: vpk.new(src), repeat))}
+
+    for name, kwargs in (("save", {}), ("save_dedup", {"dedup": True})):
+        results[name] = _report("NewVPK.%s" % name, timeit(lambda: vpk.new(src).save(output, **kwargs), repeat),
+                                byte_count)
+
+    return results
+
+
+def vpk_files(vpk_path):
+    """
+    Returns the paths of the _dir.vpk / single VPK and of its archives
+    """
+    pak = vpk.open(vpk_path)
+    indexes = {metadata[3] for _, metadata in pak.items()} - {0x7fff}
+    return [vpk_path] + [vpk._make_archive_path(vpk_path, index) for index in sorted(indexes)]
+
+
+class _MainWindowStub(object):
+    launch_options = ""
+
+
+def bench_pipeline(vpk_path, repeat, folder):
+    """
+    Times the FileProcessor stages on a zip holding the VPK, with the
+    dictionary check off so no game executable is needed
+    """
+    try:
+        import map_tools
+    except ImportError as e:
+        print("  pipeline skipped: %s" % e)
+        return {"skipped": str(e)}
+
+    base_name = os.path.splitext(os.path.basename(vpk_path))[0]
+    archive = os.path.join(folder, base_name + ".zip")
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as z:
+        for path in vpk_files(vpk_path):
+            z.write(path, os.path.basename(path))
+
+    stages = ("extract_archive", "export_vpk_files", "process_vpk", "compress_output")
+    best = dict.fromkeys(stages)
+
+    for _ in range(repeat):
+        work = os.path.join(folder, "pipeline")
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+
+        processor = map_tools.FileProcessor(archive, os.path.join(work, "rename"), work, "zip", False, None,
+                                            False, _MainWindowStub())
+        timings = {}
+
+        start = time.perf_counter()
+        processor.extract_archive()
+        timings["extract_archive"] = time.perf_counter() - start
+
+        extracted = [os.path.join(root, name) for root, _, files in os.walk(processor.temp_dir)
+                     for name in files if name.lower().endswith('.vpk')]
+        processor.input_path = next((path for path in extracted if path.lower().endswith('_dir.vpk')), extracted[0])
+        os.makedirs(processor.temp_dir_file, exist_ok=True)
+
+        start = time.perf_counter()
+        processor.export_vpk_files(processor.input_path)
+        timings["export_vpk_files"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        processor.process_vpk()
+        timings["process_vpk"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        processor.compress_output()
+        timings["compress_output"] = time.perf_counter() - start
+
+        for stage in stages:
+            best[stage] = timings[stage] if best[stage] is None else min(best[stage], timings[stage])
+
+    return {stage: _report("FileProcessor.%s" % stage, best[stage]) for stage in stages}
+
+
+def bench_vpk(vpk_path, args, src=None):
+    """
+    Runs every benchmark on one VPK, src is the directory it was packed
+    from (extracted first when None)
+    """
+    pak = vpk.open(vpk_path)
+    pak.read_index()
+    byte_count = sum(metadata[2] + metadata[5] for metadata in pak.tree.values())
+
+    print("%s: %d entries, tree %d bytes, %.1f MB of data" % (vpk_path, len(pak), pak.tree_length,
+                                                              byte_count / 2**20))
+    result = {"vpk": vpk_path, "entries": len(pak), "tree_length": pak.tree_length, "bytes": byte_count}
+
+    folder = tempfile.mkdtemp(prefix="vpk_bench_work_")
+    try:
+        result["read_index"] = bench_read_index(vpk_path, args.repeat)
+        result["read"] = bench_read(vpk_path, args.repeat, byte_count)
+        result["verify"] = bench_verify(vpk_path, args.repeat, byte_count)
+        result["extract"] = bench_extract(vpk_path, args.repeat, byte_count, folder)
+
+        if src is None:
+            src = os.path.join(folder, "extract")
+        result["new_vpk"] = bench_new_vpk(src, args.repeat, byte_count, folder)
+
+        if args.pipeline:
+            result["pipeline"] = bench_pipeline(vpk_path, args.repeat, folder)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="l4d2_vpk_lib benchmarks")
+    parser.add_argument("paths", nargs="*", help="existing VPK files to benchmark")
+    parser.add_argument("--files", type=int, default=20000, help="file count of the synthetic VPK")
+    parser.add_argument("--sizes", choices=sorted(SIZE_DISTRIBUTIONS), default="tiny",
+                        help="file size distribution of the synthetic VPK")
+    parser.add_argument("--preload", type=int, default=0, help="preload bytes per file in the synthetic VPK")
+    parser.add_argument("--archive-size", type=int, default=None,
+                        help="split the synthetic VPK into numbered archives of this size")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic VPK")
+    parser.add_argument("--repeat", type=int, default=5, help="best of N runs")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--no-pipeline", dest="pipeline", action="store_false",
+                        help="skip the FileProcessor stages")
+    args = parser.parse_args()
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "args": vars(args),
+        "results": [],
+    }
+
+    if args.paths:
+        for path in args.paths:
+            report["results"].append(bench_vpk(path, args))
+    else:
+        folder = tempfile.mkdtemp(prefix="vpk_bench_")
+        try:
+            path = make_synthetic_vpk(folder, args.files, args.seed, args.sizes, args.preload, args.archive_size)
+            report["results"].append(bench_vpk(path, args, src=os.path.join(folder, "src")))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
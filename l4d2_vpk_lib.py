@@ -1,10 +1,20 @@
+import asyncio
+import functools
 import struct
+import threading
 from binascii import crc32
-from hashlib import md5
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b, md5
 from io import open as fopen
+import fnmatch
+import io
+import mmap
 import os
 import sys
 import re
+import tempfile
+import time
 
 __version__ = "1.4.0"
 __author__ = ""
@@ -24,63 +34,187 @@ def new(*args, **kwargs):
     return NewVPK(*args, **kwargs)
 
 
+def patch(*args, **kwargs):
+    """
+    Returns a VPKPatcher instance for the specified path. Same arguments
+    """
+    return VPKPatcher(*args, **kwargs)
+
+
+async def open_async(*args, executor=None, max_concurrency=4, **kwargs):
+    """
+    Returns an AsyncVPK for specified path, opened in the executor. Same
+    arguments as open
+    """
+    loop = asyncio.get_running_loop()
+    pak = await loop.run_in_executor(executor, functools.partial(VPK, *args, **kwargs))
+    return AsyncVPK(pak, executor, max_concurrency)
+
+
 class NewVPK(object):
-    def __init__(self, path, path_enc='utf-8'):
+    """
+    Builder for VPK files. Files come from a directory (read_dir) and/or are
+    added one by one from any source with add_file and add_vpk
+    """
+    def __init__(self, path=None, path_enc='utf-8', version=1, include=None, exclude=None):
         self.path_enc = path_enc
 
         self.signature = 0x55aa1234
-        self.version = 1
+        self.version = version
         self.tree_length = 0
         self.header_length = 4*3
 
+        # version 2 only, size of the regions covered by one archive MD5
+        self.chunk_size = 2**20
+
+        # set by save(dedup=True)
+        self.duplicate_count = 0
+        self.saved_bytes = 0
+
         self.tree = {}
         self.path = ''
         self.file_count = 0
 
-        self.read_dir(path)
+        # total size of the files read by read_dir
+        self.dir_size = 0
+        # (ext, relpath, filename) -> size, for files read from self.path
+        self._file_sizes = {}
+
+        # (ext, relpath, filename) -> source, for files not read from self.path
+        self.sources = {}
+
+        if path is not None:
+            self.read_dir(path, include, exclude)
+        else:
+            self.tree_length = self.calculate_tree_length()
 
     def __repr__(self):
         return "%s('%s')" % (self.__class__.__name__, self.path)
 
-    def read_dir(self, path):
+    def read_dir(self, path, include=None, exclude=None):
         """
         Reads the given path into the tree
+
+        include and exclude are predicates on the VPK path of each file
+        (e.g. "materials/foo.vmt"), a file is read if include(path) is true
+        and exclude(path) is not. File sizes are taken from the same scan
+        and reused by save
         """
         self.tree = {}
+        self.sources = {}
+        self._file_sizes = {}
         self.file_count = 0
+        self.dir_size = 0
         self.path = path
 
-        for root, _, filelist in os.walk(path, topdown=True):
-            rel = root[len(path):].lstrip('/\\')
+        tree = self.tree
+        sizes = self._file_sizes
+        path_enc = self.path_enc
+        tree_length = 1
+        dir_size = 0
+        file_count = 0
+
+        # depth first, in the same order os.walk visits directories
+        stack = [(path, ' ', '')]
+        while stack:
+            root, rel, vpk_rel = stack.pop()
+            subdirs = []
+            # ext -> file list of this directory
+            dir_files = {}
+
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry)
+                        continue
+
+                    name = entry.name
+                    if _CJK_NAME.search(name):
+                        continue
+
+                    vpk_path = vpk_rel + name
+                    if include is not None and not include(vpk_path):
+                        continue
+                    if exclude is not None and exclude(vpk_path):
+                        continue
+
+                    filename, dot, ext = name.rpartition('.')
+                    if not dot:
+                        raise RuntimeError("Files without an extension are not supported: {0}".format(
+                                           repr(entry.path),
+                                           ))
+
+                    files = dir_files.get(ext)
+                    if files is None:
+                        if ext not in tree:
+                            tree[ext] = {}
+                            tree_length += len(ext.encode(path_enc)) + 2
+                        files = dir_files[ext] = tree[ext][rel] = []
+                        tree_length += len(rel.encode(path_enc)) + 2
+
+                    files.append(filename)
+                    tree_length += len(filename.encode(path_enc)) + 1 + 18
+
+                    size = entry.stat().st_size
+                    sizes[(ext, rel, filename)] = size
+                    dir_size += size
+                    file_count += 1
+
+            for entry in reversed(subdirs):
+                stack.append((entry.path,
+                              entry.name if rel == ' ' else os.path.join(rel, entry.name),
+                              vpk_rel + entry.name + '/'))
+
+        self.tree_length = tree_length
+        self.dir_size = dir_size
+        self.file_count = file_count
+
+    def add_file(self, vpk_path, source):
+        """
+        Adds or replaces a file at vpk_path (e.g. "materials/foo.vmt")
 
-            # empty rel, means file is in root dir
-            if not rel:
-                rel = ' '
+        source can be bytes-like, a readable file object (read once, from its
+        current position), a VPKFile from another VPK, a path on disk, or a
+        callable returning one of those which is only called while saving
+        """
+        relpath, filename = os.path.split(vpk_path.replace('\\', '/').strip('/'))
 
-            for filename in filelist:
+        filename = filename.split('.')
+        if len(filename) <= 1:
+            raise RuntimeError("Files without an extension are not supported: {0}".format(repr(vpk_path)))
 
-                if re.search(r'[\u4e00-\u9fff]',  filename): 
-                    continue 
+        ext = filename[-1]
+        filename = '.'.join(filename[:-1])
 
-                filename = filename.split('.')
-                if len(filename) <= 1:
-                    raise RuntimeError("Files without an extension are not supported: {0}".format(
-                                       repr(os.path.join(root, '.'.join(filename))),
-                                       ))
+        # same separators as read_dir, empty relpath means file is in root dir
+        relpath = relpath.replace('/', os.path.sep) or ' '
 
-                ext = filename[-1]
-                filename = '.'.join(filename[:-1])
+        if ext not in self.tree:
+            self.tree[ext] = {}
+            self.tree_length += len(ext.encode(self.path_enc)) + 2
+        if relpath not in self.tree[ext]:
+            self.tree[ext][relpath] = []
+            self.tree_length += len(relpath.encode(self.path_enc)) + 2
 
-                if ext not in self.tree:
-                    self.tree[ext] = {}
-                if rel not in self.tree[ext]:
-                    self.tree[ext][rel] = []
+        key = (ext, relpath, filename)
 
-                self.tree[ext][rel].append(filename)
-                self.file_count += 1
+        # only files read by read_dir need the list lookup
+        if key not in self.sources and not (self.path and filename in self.tree[ext][relpath]):
+            self.tree[ext][relpath].append(filename)
+            self.tree_length += len(filename.encode(self.path_enc)) + 1 + 18
+            self.file_count += 1
 
-        self.tree_length = self.calculate_tree_length()
+        self.sources[key] = source
 
+    def add_vpk(self, pak, filter=None):
+        """
+        Adds the files of an existing VPK instance, optionally only the paths
+        for which filter(path) is true. Data is copied from pak when saving
+        """
+        for path, metadata in pak.items():
+            if filter is None or filter(path):
+                self.add_file(path, pak.get_vpkfile_instance(path, metadata))
 
     def calculate_tree_length(self):
         """
@@ -89,134 +223,424 @@ class NewVPK(object):
         tree_length = 0
 
         for ext in self.tree:
-            tree_length += len(ext) + 2
+            tree_length += len(ext.encode(self.path_enc)) + 2
 
             for relpath in self.tree[ext]:
-                tree_length += len(relpath) + 2
+                tree_length += len(relpath.encode(self.path_enc)) + 2
 
                 for filename in self.tree[ext][relpath]:
-                    tree_length += len(filename) + 1 + 18
+                    tree_length += len(filename.encode(self.path_enc)) + 1 + 18
 
         return tree_length + 1
 
+    def _iter_entries(self):
+        """
+        Yields (ext, relpath, filename, source) in tree order, source
+        is a path on disk for files read from self.path
+        """
+        sources = self.sources
+        sizes = self._file_sizes
 
-    def save(self, vpk_output_path):
+        for ext in self.tree:
+            for relpath in self.tree[ext]:
+                root = os.path.join(self.path, '' if relpath == ' ' else relpath)
+
+                for filename in self.tree[ext][relpath]:
+                    key = (ext, relpath, filename)
+                    source = sources.get(key)
+
+                    if source is None:
+                        real_filename = filename if not ext else (filename + '.' + ext)
+                        source = _ScannedPath(os.path.join(root, real_filename))
+                        source.size = sizes.get(key)
+
+                    yield ext, relpath, filename, source
+
+    def _pack_tree(self, metadata):
         """
-        Saves the VPK at the given path
+        Returns the file tree as bytes. metadata holds (crc32, archive_index,
+        archive_offset, file_length) for each entry, in tree order
         """
-        with fopen(vpk_output_path, 'w+b') as f:
-            # write VPK1 header
-            f.write(struct.pack("3I", self.signature,
-                                      self.version,
-                                      self.tree_length,
+        metadata = iter(metadata)
+        tree = {}
+
+        for ext in self.tree:
+            tree[ext] = {}
+
+            for relpath in self.tree[ext]:
+                files = tree[ext]['/'.join(relpath.split(os.path.sep))] = []
+
+                for filename in self.tree[ext][relpath]:
+                    checksum, archive_index, archive_offset, file_length = next(metadata)
+                    files.append((filename, (checksum & 0xFFffFFff, b'', archive_index, archive_offset, file_length)))
+
+        return _pack_tree_dict(tree, self.path_enc)
+
+    def _write_header(self, f):
+        # write VPK1 header
+        f.write(struct.pack("3I", self.signature,
+                                  self.version,
+                                  self.tree_length,
+                                  ))
+        # write VPK2 header
+        if self.version == 2:
+            f.write(struct.pack("4I", 0, # embed_chunk_length (corrected later)
+                                      0, # chunk_hashes_length
+                                      48, # self_hashes_length
+                                      0,
                                       ))
-            # write VPK2 header
-            if self.version == 2:
-                f.write(struct.pack("4I", 0, # embed_chunk_length (corrected later)
-                                          0, # chunk_hashes_length
-                                          48, # self_hashes_length
-                                          0,
-                                          ))
 
-            self.header_length = f.tell()
+        self.header_length = f.tell()
+
+    def _write_checksums(self, f, embed_chunk_length, chunk_hashes=b''):
+        """
+        Writes embed_chunk_length, the VPK2 archive MD5 section (chunk_hashes)
+        and the self hashes section
+        """
+        f.seek(4*3) # jump back to write embed_chunk_length and chunk_hashes_length
+        f.write(struct.pack("2I", embed_chunk_length, len(chunk_hashes)))
+
+        f.seek(self.header_length + self.tree_length + embed_chunk_length)
+        f.write(chunk_hashes)
+
+        # calculate and write checksums
+        tree_checksum = md5()
+        chunk_hashes_checksum = md5()
+        file_checksum = md5()
+
+        def chunk_reader(length, chunk_size=2**14):
+            limit = f.tell() + length
 
-            data_offset = self.header_length + self.tree_length
+            while f.tell() < limit:
+                yield f.read(min(chunk_size, limit - f.tell()))
 
-            embed_chunk_length = 0
+        f.seek(0) # jump to start
+        file_checksum.update(f.read(self.header_length))
 
-            # write file tree
-            for ext in self.tree:
-                f.write(ext.encode(self.path_enc) + b"\x00")
+        for chunk in chunk_reader(self.tree_length):
+            file_checksum.update(chunk)
+            tree_checksum.update(chunk)
 
-                for relpath in self.tree[ext]:
-                    norm_relpath = '/'.join(relpath.split(os.path.sep))
-                    f.write(norm_relpath.encode(self.path_enc) + b"\x00")
+        for chunk in chunk_reader(embed_chunk_length):
+            file_checksum.update(chunk)
 
-                    for filename in self.tree[ext][relpath]:
-                        f.write(filename.encode(self.path_enc) + b'\x00')
+        for chunk in chunk_reader(len(chunk_hashes)):
+            file_checksum.update(chunk)
+            chunk_hashes_checksum.update(chunk)
 
-                        # append file data
-                        metadata_offset = f.tell()
-                        file_offset = data_offset
-                        real_filename = filename if not ext else (filename + '.' + ext)
-                        checksum = 0
-                        f.seek(data_offset)
-
-                        with fopen(os.path.join(self.path,
-                                                '' if relpath == ' ' else relpath,
-                                                real_filename
-                                                ),
-                                   'rb') as pakfile:
-                            for chunk in iter(lambda: pakfile.read(8192), b''):
-                                checksum = crc32(chunk, checksum)
-                                f.write(chunk)
-
-                        data_offset = f.tell()
-                        file_length = f.tell() - file_offset
-                        f.seek(metadata_offset)
-
-                        embed_chunk_length += file_length
-                        # metadata
-
-                        # crc32
-                        # preload_length
-                        # archive_index
-                        # archive_offset
-                        # file_length
-                        # suffix
-                        f.write(struct.pack("IHHIIH", checksum & 0xFFffFFff,
-                                                      0,
-                                                      0x7fff,
-                                                      file_offset - self.tree_length - self.header_length,
-                                                      file_length,
-                                                      0xffff
-                                                      ))
+        file_checksum.update(tree_checksum.digest())
+        file_checksum.update(chunk_hashes_checksum.digest())
 
+        f.write(tree_checksum.digest())
+        f.write(chunk_hashes_checksum.digest())
+        f.write(file_checksum.digest())
 
-                    # next relpath
-                    f.write(b"\x00")
-                # next ext
-                f.write(b"\x00")
-            # end of file tree
-            f.write(b"\x00")
+    def save(self, vpk_output_path, max_archive_size=None, workers=None, prefetch_bytes=2**26, dedup=False):
+        """
+        Saves the VPK at the given path, returns the list of written files
 
-            if self.version == 2:
-                f.seek(4*3) # jump back to write embed_chunk_length
-                f.write(struct.pack("1I", embed_chunk_length))
+        With max_archive_size the file data is split over numbered archives
+        (name_000.vpk, name_001.vpk, ...) of at most that many bytes, a larger
+        file gets an archive of its own, and the tree goes to name_dir.vpk.
+        The archives are written in parallel by up to workers threads
 
-                # calculate and write checksums
-                tree_checksum = md5()
-                chunk_hashes_checksum = md5()
-                file_checksum = md5()
+        Without it, workers threads read files and compute their CRC32 ahead
+        of the writer, holding at most prefetch_bytes of file data at once
 
-                def chunk_reader(length, chunk_size=2**14):
-                    limit = f.tell() + length
+        With dedup, files with identical contents are stored once and their
+        entries share the data offset. duplicate_count and saved_bytes are
+        updated with what was saved
+        """
+        self.tree_length = self.calculate_tree_length()
+        self.duplicate_count = 0
+        self.saved_bytes = 0
+
+        if max_archive_size is not None:
+            return self._save_archives(vpk_output_path, max_archive_size, workers, dedup)
 
-                    while f.tell() < limit:
-                        yield f.read(min(chunk_size, limit - f.tell()))
+        with fopen(vpk_output_path, 'w+b') as f:
+            self._write_header(f)
 
-                f.seek(0) # jump to start
-                file_checksum.update(f.read(self.header_length))
+            # file data goes after the tree, which is written once all
+            # checksums are known
+            f.seek(self.header_length + self.tree_length)
 
-                for chunk in chunk_reader(self.tree_length):
-                    file_checksum.update(chunk)
-                    tree_checksum.update(chunk)
+            layout = _ArchiveLayout()
+            metadata = []
+            sources = [source for ext, relpath, filename, source in self._iter_entries()]
 
-                for chunk in chunk_reader(embed_chunk_length):
-                    file_checksum.update(chunk)
+            # duplicates are found while copying, only files sharing their
+            # length with another one are hashed
+            lengths = [_source_length(source) for source in sources] if dedup else None
+            shared_lengths = _shared_lengths(lengths) if dedup else ()
+            contents = {}
 
-                # not supported (chunk_hashes_length == 0)
-                #for chunk in chunk_reader(self.chunk_hashes_length):
-                #    file_checksum.update(chunk)
-                #    chunk_hashes_checksum.update(chunk)
+            if workers and workers > 1:
+                staged_sources = _stage_sources(sources, workers, prefetch_bytes)
+            else:
+                staged_sources = ((source, None) for source in sources)
+
+            for entry_index, (source, staged) in enumerate(staged_sources):
+                digest = blake2b(digest_size=20) if dedup and lengths[entry_index] in shared_lengths else None
+
+                if staged is None and digest is not None and lengths[entry_index] <= prefetch_bytes:
+                    # hashed before writing so that a duplicate is never written
+                    staged = _stage_source(source, lengths[entry_index])
+
+                if staged is None:
+                    checksum, file_length = _copy_source(source, f, digest)
+                else:
+                    checksum, file_length, chunks = staged
+                    if digest is not None:
+                        for chunk in chunks:
+                            digest.update(chunk)
+
+                original = None
+                if digest is not None:
+                    key = (file_length, digest.digest())
+                    original = contents.setdefault(key, entry_index)
+
+                if original is not None and original != entry_index:
+                    if staged is None:
+                        # already copied, the original holds the same bytes
+                        f.seek(-file_length, os.SEEK_CUR)
+                        f.truncate()
+                    metadata.append(metadata[original])
+                    self.duplicate_count += 1
+                    self.saved_bytes += file_length
+                    continue
+
+                if staged is not None:
+                    for chunk in chunks:
+                        f.write(chunk)
+
+                archive_index, archive_offset = layout.place(file_length, source)
+                metadata.append((checksum, archive_index, archive_offset, file_length))
+
+            data_offset = layout.data_size
 
-                file_checksum.update(tree_checksum.digest())
-                file_checksum.update(chunk_hashes_checksum.digest())
+            f.seek(self.header_length)
+            f.write(self._pack_tree(metadata))
 
-                f.write(tree_checksum.digest())
-                f.write(chunk_hashes_checksum.digest())
-                f.write(file_checksum.digest())
+            if self.version == 2:
+                f.flush()
+                chunk_hashes = _hash_chunks([(0x7fff, vpk_output_path, self.header_length + self.tree_length, data_offset)],
+                                            self.chunk_size, workers)
+                self._write_checksums(f, data_offset, b''.join(chunk_hashes))
 
+        return [vpk_output_path]
+
+    def _find_duplicates(self, sources, workers, lengths=None):
+        """
+        Returns {entry index: index of the first entry with the same contents}.
+        Only sources sharing their length with another one are hashed
+        """
+        if lengths is None:
+            lengths = [_source_length(source) for source in sources]
+
+        by_length = {}
+        for entry_index, length in enumerate(lengths):
+            if length:
+                by_length.setdefault(length, []).append(entry_index)
+
+        candidates = [entry_index for group in by_length.values() if len(group) > 1 for entry_index in group]
+
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+            digests = executor.map(lambda entry_index: _digest_source(sources[entry_index]), candidates)
+
+            first = {}
+            duplicates = {}
+            # candidates are in tree order within each length, so the
+            # original is always the entry that comes first
+            for entry_index, digest in zip(candidates, digests):
+                key = (lengths[entry_index], digest)
+                if key in first:
+                    duplicates[entry_index] = first[key]
+                else:
+                    first[key] = entry_index
+
+        self.duplicate_count = len(duplicates)
+        self.saved_bytes = sum(lengths[entry_index] for entry_index in duplicates)
+
+        return duplicates
+
+    def _save_archives(self, vpk_output_path, max_archive_size, workers, dedup=False):
+        layout = _ArchiveLayout(max_archive_size)
+        dir_path = _make_dir_path(vpk_output_path)
+
+        sources, lengths = [], []
+        for ext, relpath, filename, source in self._iter_entries():
+            source, file_length = _sized_source(source)
+            sources.append(source)
+            lengths.append(file_length)
+
+        duplicates = self._find_duplicates(sources, workers, lengths) if dedup else {}
+
+        # lay out the entries over the archives, in tree order
+        archives = []
+        for entry_index, (source, file_length) in enumerate(zip(sources, lengths)):
+            if entry_index in duplicates:
+                continue
+
+            archive_index, archive_offset = layout.place(file_length, source)
+            if archive_index == len(archives):
+                archives.append([])
+            archives[archive_index].append((entry_index, source, archive_offset, file_length))
+
+        archive_paths = [_make_archive_path(dir_path, archive_index) for archive_index in range(len(archives))]
+        metadata = [None] * len(sources)
+
+        def write_archive(archive_index):
+            with fopen(archive_paths[archive_index], 'wb') as f:
+                for entry_index, source, archive_offset, file_length in archives[archive_index]:
+                    checksum, length = _copy_source(source, f)
+                    if length != file_length:
+                        raise RuntimeError("File changed while saving: {0}".format(repr(source)))
+
+                    metadata[entry_index] = (checksum, archive_index, archive_offset, file_length)
+
+        if archives:
+            with ThreadPoolExecutor(max_workers=workers or min(4, len(archives))) as executor:
+                for _ in executor.map(write_archive, range(len(archives))):
+                    pass
+
+        for entry_index, original in duplicates.items():
+            metadata[entry_index] = metadata[original]
+
+        with fopen(dir_path, 'w+b') as f:
+            self._write_header(f)
+            f.write(self._pack_tree(metadata))
+
+            if self.version == 2:
+                chunk_hashes = _hash_chunks([(archive_index, archive_paths[archive_index], 0, layout.archive_sizes[archive_index])
+                                             for archive_index in range(len(archives))],
+                                            self.chunk_size, workers)
+                self._write_checksums(f, 0, b''.join(chunk_hashes))
+
+        return [dir_path] + archive_paths
+
+    def save_tee(self, outputs, workers=None, prefetch_bytes=2**26, dedup=False):
+        """
+        Saves several VPKs from the files of this one in a single read pass
+
+        outputs is a list of (vpk_output_path, filter, max_archive_size),
+        filter(path) selects the files of that VPK (all of them when None)
+        and max_archive_size works as in save. Every file is read once and
+        written to each VPK that selects it, workers threads read ahead as in
+        save. Version 1 only
+
+        Returns a list of (NewVPK, written paths) for the outputs, the NewVPK
+        holds the tree and the dedup counts of that output. Duplicates are
+        found while copying, per output
+        """
+        if self.version != 1:
+            raise ValueError("save_tee only supports version 1")
+
+        sources, lengths, paths = [], [], []
+        for ext, relpath, filename, source in self._iter_entries():
+            source, file_length = _sized_source(source)
+            sources.append(source)
+            lengths.append(file_length)
+            paths.append(_entry_path(ext, relpath, filename))
+
+        shared_lengths = _shared_lengths(lengths) if dedup else ()
+
+        writers = []
+        try:
+            for vpk_output_path, path_filter, max_archive_size in outputs:
+                pack = NewVPK(path_enc=self.path_enc)
+                selected = [entry_index for entry_index, path in enumerate(paths)
+                            if path_filter is None or path_filter(path)]
+                for entry_index in selected:
+                    pack.add_file(paths[entry_index], sources[entry_index])
+
+                writers.append(_TeeWriter(pack, vpk_output_path, max_archive_size, selected))
+
+            targets = []
+            for entry_index in range(len(sources)):
+                entry_targets = [writer for writer in writers if entry_index in writer.selected]
+                if entry_targets:
+                    targets.append((entry_index, entry_targets))
+
+            selected_sources = (sources[entry_index] for entry_index, _ in targets)
+            if workers and workers > 1:
+                staged_sources = _stage_sources(selected_sources, workers, prefetch_bytes)
+            else:
+                staged_sources = ((source, None) for source in selected_sources)
+
+            for entry_index, entry_targets in targets:
+                source, staged = next(staged_sources)
+                file_length = lengths[entry_index]
+                digest = blake2b(digest_size=20) if file_length in shared_lengths else None
+                key = None
+
+                if staged is None and digest is not None and file_length <= prefetch_bytes:
+                    # hashed before writing so that a duplicate is never written
+                    staged = _stage_source(source, file_length)
+
+                if staged is not None and digest is not None:
+                    for chunk in staged[2]:
+                        digest.update(chunk)
+                    key = (file_length, digest.digest())
+                    digest = None
+                    entry_targets = [writer for writer in entry_targets
+                                     if not writer.share(entry_index, key, file_length)]
+                    if not entry_targets:
+                        continue
+
+                chunks = _iter_source(source) if staged is None else staged[2]
+
+                for writer in entry_targets:
+                    writer.begin(file_length, source)
+
+                checksum = 0
+                copied = 0
+                for chunk in chunks:
+                    checksum = crc32(chunk, checksum)
+                    if digest is not None:
+                        digest.update(chunk)
+                    copied += len(chunk)
+                    for writer in entry_targets:
+                        writer.f.write(chunk)
+
+                if copied != file_length:
+                    raise RuntimeError("File changed while saving: {0}".format(repr(source)))
+
+                if digest is not None:
+                    key = (file_length, digest.digest())
+
+                for writer in entry_targets:
+                    writer.end(entry_index, checksum & 0xFFffFFff, file_length, key)
+
+            return [(writer.pack, writer.finish()) for writer in writers]
+        finally:
+            for writer in writers:
+                writer.close()
+
+    def partition(self, max_size):
+        """
+        Splits the files into parts of at most max_size bytes of data,
+        largest files first, a file over max_size gets a part of its own.
+        Files of unknown length count as empty
+
+        Returns a set of VPK paths per part, pass part.__contains__ as the
+        filter of a save_tee output to save each part as its own VPK
+        """
+        files = []
+        for ext, relpath, filename, source in self._iter_entries():
+            files.append((_source_length(source) or 0, _entry_path(ext, relpath, filename)))
+        files.sort(key=lambda item: item[0], reverse=True)
+
+        parts = []
+        part_size = 0
+        for file_length, path in files:
+            if not parts or (parts[-1] and part_size + file_length > max_size):
+                parts.append(set())
+                part_size = 0
+            parts[-1].add(path)
+            part_size += file_length
+
+        return parts
 
     def save_and_open(self, path):
         """
@@ -226,20 +650,750 @@ class NewVPK(object):
         return VPK(path)
 
 
-def _read_cstring(f, encoding='utf-8'):
-    buf = b''
-    for chunk in iter(lambda: f.read(64),  b''):
-        pos = chunk.find(b'\x00') 
-        if pos > -1:
-            buf += chunk[:pos]
-            f.seek(f.tell()  - (len(chunk) - (pos + 1)))
-            break 
-        buf += chunk 
- 
+class _ArchiveLayout(object):
+    """
+    Places the file data of a VPK, after the tree when max_archive_size is
+    None, otherwise in numbered archives of at most max_archive_size bytes
+    (a larger file gets an archive of its own). Holds the size limits of
+    the format for every writer
+    """
+    def __init__(self, max_archive_size=None):
+        if max_archive_size is not None and not 0 < max_archive_size <= 0xFFFFFFFF:
+            raise ValueError("max_archive_size must be between 1 byte and 4 GiB")
+
+        self.max_archive_size = max_archive_size
+        self.data_size = 0
+        self.archive_sizes = []
+        # whether the last file placed started a new archive
+        self.opened = False
+
+    def place(self, file_length, source=None):
+        """
+        Returns (archive_index, archive_offset) of the next file
+        """
+        if file_length > 0xFFFFFFFF:
+            raise ValueError("Files over 4 GiB are not supported: {0}".format(repr(source)))
+
+        if self.max_archive_size is None:
+            if self.data_size > 0xFFFFFFFF:
+                raise ValueError("VPK data exceeds 4 GiB, use max_archive_size")
+
+            archive_offset = self.data_size
+            self.data_size += file_length
+            return 0x7fff, archive_offset
+
+        archive_sizes = self.archive_sizes
+        self.opened = not archive_sizes or bool(archive_sizes[-1] and
+                                                archive_sizes[-1] + file_length > self.max_archive_size)
+        if self.opened:
+            # 0x7fff is the embedded data
+            if len(archive_sizes) >= 0x7fff:
+                raise ValueError("Too many archives, increase max_archive_size")
+            archive_sizes.append(0)
+
+        archive_offset = archive_sizes[-1]
+        archive_sizes[-1] += file_length
+        return len(archive_sizes) - 1, archive_offset
+
+    def unplace(self, file_length):
+        """
+        Takes back the last file placed, returns True if the archive it
+        started was dropped
+        """
+        if self.max_archive_size is None:
+            self.data_size -= file_length
+            return False
+
+        self.archive_sizes[-1] -= file_length
+        if self.opened:
+            self.archive_sizes.pop()
+        return self.opened
+
+
+class _TeeWriter(object):
+    """
+    One output of NewVPK.save_tee. Data is appended after the tree of a
+    single VPK, or to numbered archives of at most max_archive_size bytes
+    """
+    def __init__(self, pack, vpk_output_path, max_archive_size, selected):
+        self.pack = pack
+        self.selected = dict.fromkeys(selected)
+        self.layout = _ArchiveLayout(max_archive_size)
+        self.metadata = {}
+        # (file_length, digest) -> entry index of the first file with that content
+        self.contents = {}
+        self.archive_paths = []
+        self.placement = None
+        self.f = None
+
+        pack.tree_length = pack.calculate_tree_length()
+
+        if max_archive_size is None:
+            self.path = vpk_output_path
+            self.f = fopen(vpk_output_path, 'w+b')
+            pack._write_header(self.f)
+            self.f.seek(pack.header_length + pack.tree_length)
+        else:
+            self.path = _make_dir_path(vpk_output_path)
+
+    def share(self, entry_index, key, file_length):
+        """
+        Points an entry at an earlier file of this VPK with the same content
+        key, returns False if there is none
+        """
+        original = self.contents.get(key)
+        if original is None:
+            return False
+
+        self.metadata[entry_index] = self.metadata[original]
+        self.pack.duplicate_count += 1
+        self.pack.saved_bytes += file_length
+        return True
+
+    def begin(self, file_length, source=None):
+        """
+        Prepares to append a file of file_length bytes
+        """
+        archive_index, archive_offset = self.layout.place(file_length, source)
+
+        if archive_index != 0x7fff and archive_index == len(self.archive_paths):
+            if self.f is not None:
+                self.f.close()
+
+            self.archive_paths.append(_make_archive_path(self.path, archive_index))
+            self.f = fopen(self.archive_paths[-1], 'wb')
+
+        self.placement = (archive_index, archive_offset)
+
+    def end(self, entry_index, checksum, file_length, key=None):
+        """
+        Records the file appended since begin. With a content key, a
+        duplicate of an earlier file is truncated back and shares its data
+        """
+        if key is not None and self.share(entry_index, key, file_length):
+            self.f.seek(-file_length, os.SEEK_CUR)
+            self.f.truncate()
+
+            if self.layout.unplace(file_length):
+                # the duplicate alone started that archive, the original
+                # is in an earlier one
+                self.f.close()
+                os.remove(self.archive_paths.pop())
+                self.f = fopen(self.archive_paths[-1], 'ab')
+            return
+
+        if key is not None:
+            self.contents[key] = entry_index
+        self.metadata[entry_index] = (checksum,) + self.placement + (file_length,)
+
+    def finish(self):
+        """
+        Writes the tree, returns the written paths
+        """
+        tree = self.pack._pack_tree([self.metadata[entry_index] for entry_index in self.selected])
+
+        if self.layout.max_archive_size is None:
+            self.f.seek(self.pack.header_length)
+            self.f.write(tree)
+            self.close()
+            return [self.path]
+
+        self.close()
+        with fopen(self.path, 'wb') as f:
+            self.pack._write_header(f)
+            f.write(tree)
+
+        return [self.path] + self.archive_paths
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+# crc32, preload_length, archive_index, archive_offset, file_length, suffix
+_ENTRY_META = struct.Struct("IHHIIH")
+
+
+# archive_index, starting_offset, count, md5
+_CHUNK_HASH = struct.Struct("3I16s")
+
+# file names NewVPK.read_dir skips
+_CJK_NAME = re.compile(r'[\u4e00-\u9fff]')
+
+
+def has_cjk_name(vpk_path):
+    """
+    Returns True if the file name of vpk_path has CJK characters, such
+    files are skipped by NewVPK.read_dir
+    """
+    return _CJK_NAME.search(vpk_path.replace('\\', '/').rpartition('/')[2]) is not None
+
+
+class _ScannedPath(str):
+    """
+    Path of a file read by NewVPK.read_dir, size is the size it had then
+    """
+    size = None
+
+
+def _path_length(path):
+    size = getattr(path, 'size', None)
+    return os.path.getsize(path) if size is None else size
+
+
+def _hash_chunks(regions, chunk_size, workers=None):
+    """
+    Returns packed VPK2 archive MD5 entries for the given regions, a list of
+    (archive_index, path, start, length), hashed chunk_size bytes at a time
+    on a thread pool. Chunk offsets are relative to start; for archive index
+    0x7fff start is where the embedded data begins
+    """
+    chunks = [(archive_index, path, start, offset, min(chunk_size, length - offset))
+              for archive_index, path, start, length in regions
+              for offset in range(0, length, chunk_size)]
+    pool = _ArchivePool(max_handles=len(regions) or 1)
+
+    def hash_chunk(chunk):
+        archive_index, path, start, offset, count = chunk
+        return _CHUNK_HASH.pack(archive_index, offset, count, md5(pool.read(path, count, start + offset)).digest())
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+            return list(executor.map(hash_chunk, chunks))
+    finally:
+        pool.close()
+
+
+def _entry_path(ext, relpath, filename):
+    """
+    Returns the VPK path of a NewVPK tree entry, e.g. "materials/foo.vmt"
+    """
+    return ('' if relpath == ' ' else relpath.replace(os.path.sep, '/') + '/') + filename + '.' + ext
+
+
+def _make_dir_path(vpk_output_path):
+    """
+    Returns the path of the directory file of a multi-archive VPK,
+    name.vpk -> name_dir.vpk
+    """
+    if vpk_output_path.endswith('_dir.vpk'):
+        return vpk_output_path
+    return os.path.splitext(vpk_output_path)[0] + '_dir.vpk'
+
+
+def _make_archive_path(dir_path, archive_index):
+    """
+    Returns the path of a numbered archive, name_dir.vpk -> name_000.vpk
+    """
+    return dir_path[:-len('dir.vpk')] + "%03d.vpk" % archive_index
+
+
+def _buffer_size(f, chunk_size):
+    """
+    Returns the size of a read buffer for the file object f, at most what
+    is left of the file, so that small files do not get a full chunk
+    """
+    try:
+        remaining = os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, OSError, ValueError):
+        return chunk_size
+    return max(1, min(chunk_size, remaining))
+
+
+def _iter_source(source, chunk_size=2**20):
+    """
+    Yields the contents of a NewVPK source as memoryviews. Views may share
+    one buffer, so each chunk has to be consumed before the next one
+    """
+    if callable(source):
+        source = source()
+
+    if isinstance(source, (str, os.PathLike)):
+        with fopen(source, 'rb', buffering=0) as f:
+            size = getattr(source, 'size', None)
+            size = _buffer_size(f, chunk_size) if size is None else max(1, min(chunk_size, size))
+            buf = memoryview(bytearray(size))
+            for size in iter(lambda: f.readinto(buf), 0):
+                yield buf[:size]
+    elif isinstance(source, VPKFile):
+        for chunk in source.iter_chunks(chunk_size):
+            yield chunk
+    elif hasattr(source, 'readinto'):
+        buf = memoryview(bytearray(_buffer_size(source, chunk_size)))
+        for size in iter(lambda: source.readinto(buf), 0):
+            yield buf[:size]
+    elif hasattr(source, 'read'):
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            yield memoryview(chunk)
+    else:
+        view = memoryview(source).cast('B')
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+
+
+def _sized_source(source):
+    """
+    Returns (source, length). Callables are called, streams of unknown
+    length are spooled to a temporary file
+    """
+    if callable(source):
+        source = source()
+
+    if isinstance(source, (str, os.PathLike)):
+        return source, _path_length(source)
+    if isinstance(source, VPKFile):
+        return source, source.length
+    if not hasattr(source, 'read'):
+        return source, memoryview(source).nbytes
+
+    try:
+        return source, os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, OSError, ValueError):
+        pass
+
+    spool = tempfile.SpooledTemporaryFile(max_size=2**24)
+    for chunk in _iter_source(source):
+        spool.write(chunk)
+    length = spool.tell()
+    spool.seek(0)
+
+    return spool, length
+
+
+def _source_length(source):
+    """
+    Returns the length of a NewVPK source if it is known without reading it
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return _path_length(source)
+    if isinstance(source, VPKFile):
+        return source.length
+    if callable(source) or hasattr(source, 'read'):
+        return None
+    return memoryview(source).nbytes
+
+
+def _stage_source(source, length):
+    """
+    Reads a source of known length into memory, returns (crc32, length, chunks)
+    """
+    if isinstance(source, (str, os.PathLike)):
+        buf = bytearray(length)
+        with fopen(source, 'rb') as f:
+            size = f.readinto(buf)
+            # file grew since it was sized
+            chunks = [memoryview(buf)[:size], f.read()]
+    elif isinstance(source, VPKFile):
+        buf = bytearray(length)
+        source.seek(0)
+        chunks = [memoryview(buf)[:source.readinto(buf)]]
+    else:
+        chunks = [memoryview(source).cast('B')]
+
+    checksum = 0
+    for chunk in chunks:
+        checksum = crc32(chunk, checksum)
+
+    return checksum & 0xFFffFFff, sum(len(chunk) for chunk in chunks), chunks
+
+
+def _stage_sources(sources, workers, prefetch_bytes, max_pending=4096):
+    """
+    Yields (source, staged) in order. Sources of known length up to
+    prefetch_bytes are read and checksummed ahead by a thread pool (zlib
+    releases the GIL) and staged is (crc32, length, chunks). For other
+    sources staged is None and the caller streams them itself.
+
+    At most prefetch_bytes of staged data is held at once
+    """
+    sources = iter(sources)
+    pending = deque()
+    staged_bytes = 0
+    exhausted = False
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        while True:
+            while not exhausted and staged_bytes < prefetch_bytes and len(pending) < max_pending:
+                source = next(sources, None)
+                if source is None:
+                    exhausted = True
+                    break
+
+                length = _source_length(source)
+                if length is None or length > prefetch_bytes:
+                    pending.append((source, None, 0))
+                else:
+                    pending.append((source, executor.submit(_stage_source, source, length), length))
+                    staged_bytes += length
+
+            if not pending:
+                break
+
+            source, future, length = pending.popleft()
+            yield source, future.result() if future else None
+            staged_bytes -= length
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _digest_source(source):
+    """
+    Returns a content digest of a NewVPK source
+    """
+    digest = blake2b(digest_size=20)
+
+    # file objects are read again when saving
+    pos = source.tell() if hasattr(source, 'read') and hasattr(source, 'seek') else None
+
+    for chunk in _iter_source(source):
+        digest.update(chunk)
+
+    if pos is not None:
+        source.seek(pos)
+
+    return digest.digest()
+
+
+def _shared_lengths(lengths):
+    """
+    Returns the non-zero lengths found more than once, only files of those
+    lengths can be duplicates of each other
+    """
+    seen = set()
+    shared = set()
+    for length in lengths:
+        if length:
+            (shared if length in seen else seen).add(length)
+
+    return shared
+
+
+def _copy_source(source, f, digest=None):
+    """
+    Appends a NewVPK source to f, returns (crc32, length). The data is also
+    fed to digest when given
+    """
+    checksum = 0
+    length = 0
+
+    for chunk in _iter_source(source):
+        checksum = crc32(chunk, checksum)
+        f.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        length += len(chunk)
+
+    return checksum & 0xFFffFFff, length
+
+
+# magic, size, mtime_ns, tree crc32, tree_length, entry count,
+# lengths of the VPK path and of the path table
+_INDEX_HEADER = struct.Struct("<8sQqIIIII")
+_INDEX_MAGIC = b"VPKIDX02"
+# preload offset, crc32, preload_length, archive_index, archive_offset, file_length
+_INDEX_META = struct.Struct("<IIHHII")
+
+
+def _save_index_cache(cache_path, key, tree, path_enc):
+    """
+    Writes an index parsed with lazy_preload to cache_path. Failures are
+    ignored, the cache is only an optimisation
+    """
+    vpk_path, size, mtime_ns, tree_checksum, tree_length = key
+    vpk_path = vpk_path.encode('utf-8', 'surrogateescape')
+
+    paths = '\x00'.join(tree).encode(path_enc, 'surrogateescape')
+    metadata = b''.join(_INDEX_META.pack(entry[0] or 0, *entry[1:]) for entry in tree.values())
+
+    header = _INDEX_HEADER.pack(_INDEX_MAGIC, size, mtime_ns, tree_checksum, tree_length,
+                                len(tree), len(vpk_path), len(paths))
+    temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+
+    try:
+        with fopen(temp_path, 'wb') as f:
+            f.write(b''.join((header, vpk_path, paths, metadata)))
+        os.replace(temp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def _load_index_cache(cache_path, key, path_enc):
+    """
+    Returns the index stored at cache_path, with lazy preload offsets, or
+    None when it is missing, unreadable or was written for a different key
+    """
     try:
-        return buf.decode(encoding,  errors='strict')
-    except UnicodeDecodeError:
-        return ' '
+        with fopen(cache_path, 'rb') as f:
+            data = f.read()
+
+        (magic, size, mtime_ns, tree_checksum, tree_length,
+         count, vpk_path_length, paths_length) = _INDEX_HEADER.unpack_from(data)
+
+        pos = _INDEX_HEADER.size
+        vpk_path = data[pos:pos + vpk_path_length].decode('utf-8', 'surrogateescape')
+        pos += vpk_path_length
+
+        if magic != _INDEX_MAGIC or (vpk_path, size, mtime_ns, tree_checksum, tree_length) != key:
+            return None
+
+        paths = data[pos:pos + paths_length].decode(path_enc, 'surrogateescape').split('\x00') if count else []
+        pos += paths_length
+
+        if len(paths) != count or len(data) != pos + count * _INDEX_META.size:
+            return None
+
+        return {path: (entry[0] if entry[2] else b'',) + entry[1:]
+                for path, entry in zip(paths, _INDEX_META.iter_unpack(data[pos:]))}
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def _pack_tree_entries(entries, path_enc='utf-8'):
+    """
+    Returns a file tree as bytes for a dict of path -> (crc32, preload,
+    archive_index, archive_offset, file_length), with archive_offset as
+    stored in the tree
+    """
+    tree = {}
+    for path, metadata in entries.items():
+        relpath, _, filename = path.rpartition('/')
+        filename, _, ext = filename.rpartition('.')
+        tree.setdefault(ext, {}).setdefault(relpath or ' ', []).append((filename, metadata))
+
+    return _pack_tree_dict(tree, path_enc)
+
+
+def _pack_tree_dict(tree, path_enc='utf-8'):
+    """
+    Returns a file tree as bytes for a dict of ext -> relpath -> list of
+    (filename, (crc32, preload, archive_index, archive_offset, file_length)),
+    relpaths separated by '/'
+    """
+    parts = []
+    for ext in tree:
+        parts.append(ext.encode(path_enc) + b"\x00")
+
+        for relpath in tree[ext]:
+            parts.append(relpath.encode(path_enc) + b"\x00")
+
+            for filename, (checksum, preload, archive_index, archive_offset, file_length) in tree[ext][relpath]:
+                parts.append(filename.encode(path_enc) + b"\x00")
+                parts.append(_ENTRY_META.pack(checksum, len(preload), archive_index, archive_offset, file_length, 0xffff))
+                parts.append(preload)
+
+            # next relpath
+            parts.append(b"\x00")
+        # next ext
+        parts.append(b"\x00")
+    # end of file tree
+    parts.append(b"\x00")
+
+    return b''.join(parts)
+
+
+class _PooledHandle(object):
+    __slots__ = ('f', 'fd', 'lock', 'refs', 'evicted')
+
+    def __init__(self, f):
+        self.f = f
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.evicted = False
+
+        try:
+            self.fd = f.fileno() if hasattr(os, 'pread') else None
+        except (AttributeError, OSError, ValueError):
+            self.fd = None
+
+
+class _ArchivePool(object):
+    """
+    Shared read handles, one per archive path, closed least recently used
+    first once there are more than max_handles of them
+
+    Reads are positional (os.pread) so there is no seek state and any number
+    of threads can read through the same handle. Where os.pread is missing
+    (Windows) or fopen returns objects without a fileno, reads fall back to
+    seek + readinto under a per-handle lock
+    """
+    def __init__(self, fopen=fopen, max_handles=16):
+        self.fopen = fopen
+        self.max_handles = max_handles
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    def _acquire(self, path):
+        with self._lock:
+            handle = self._handles.get(path)
+
+            if handle is None:
+                handle = self._handles[path] = _PooledHandle(self.fopen(path, 'rb'))
+
+                # evict the least recently used handles, busy ones are closed on release
+                for old_path in list(self._handles):
+                    if len(self._handles) <= self.max_handles:
+                        break
+                    old = self._handles[old_path]
+                    if old is handle:
+                        continue
+                    del self._handles[old_path]
+                    if old.refs:
+                        old.evicted = True
+                    else:
+                        old.f.close()
+            else:
+                self._handles.move_to_end(path)
+
+            handle.refs += 1
+            return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.refs -= 1
+            if handle.evicted and handle.refs == 0:
+                handle.f.close()
+
+    def readinto(self, path, b, offset):
+        """
+        Reads into the buffer b from the given absolute offset, returns the count
+        """
+        view = memoryview(b).cast('B')
+        handle = self._acquire(path)
+
+        try:
+            if handle.fd is None:
+                with handle.lock:
+                    handle.f.seek(offset)
+                    return handle.f.readinto(view)
+
+            pos = 0
+            while pos < len(view):
+                data = os.pread(handle.fd, len(view) - pos, offset + pos)
+                if not data:
+                    break
+                view[pos:pos + len(data)] = data
+                pos += len(data)
+            return pos
+        finally:
+            self._release(handle)
+
+    def read(self, path, size, offset):
+        """
+        Returns up to size bytes from the given absolute offset
+        """
+        handle = self._acquire(path)
+
+        try:
+            if handle.fd is None:
+                with handle.lock:
+                    handle.f.seek(offset)
+                    return handle.f.read(size)
+
+            data = os.pread(handle.fd, size, offset)
+            if 0 < len(data) < size:
+                buf = bytearray(size)
+                buf[:len(data)] = data
+                return bytes(buf[:len(data) + self.readinto(path, memoryview(buf)[len(data):], offset + len(data))])
+            return data
+        finally:
+            self._release(handle)
+
+    def copy_range(self, path, out_fd, offset, count):
+        """
+        Copies up to count bytes from the given absolute offset to the current
+        position of out_fd with os.copy_file_range, returns the count copied.
+        That is 0 where copy_file_range is missing or refused, callers copy
+        the rest themselves
+        """
+        if not hasattr(os, 'copy_file_range'):
+            return 0
+
+        handle = self._acquire(path)
+
+        try:
+            if handle.fd is None:
+                return 0
+
+            pos = 0
+            while pos < count:
+                try:
+                    copied = os.copy_file_range(handle.fd, out_fd, count - pos, offset + pos)
+                except OSError:
+                    break
+                if not copied:
+                    break
+                pos += copied
+            return pos
+        finally:
+            self._release(handle)
+
+    def close(self):
+        with self._lock:
+            handles, self._handles = self._handles, OrderedDict()
+
+            for handle in handles.values():
+                if handle.refs:
+                    handle.evicted = True
+                else:
+                    handle.f.close()
+
+
+class _DirNode(object):
+    """
+    Directory of the VPK path trie, keyed by lowercased names like the
+    engine compares them. files maps a lowercased file name to its VPK path
+    """
+    __slots__ = ('name', 'dirs', 'files')
+
+    def __init__(self, name):
+        self.name = name
+        self.dirs = {}
+        self.files = {}
+
+    def walk_files(self):
+        for path in self.files.values():
+            yield path
+        for node in self.dirs.values():
+            for path in node.walk_files():
+                yield path
+
+
+_GLOB_MAGIC = re.compile('[*?[]')
+
+
+def _normalize_vpk_path(path):
+    return path.replace('\\', '/').strip('/')
+
+
+# a file whose data could not be read (error) or does not match its crc32
+VerifyFailure = namedtuple('VerifyFailure', ['path', 'archive_index', 'archive_offset',
+                                             'expected_crc32', 'actual_crc32', 'error'])
+
+
+class VerifyResult(namedtuple('VerifyResult', ['failures', 'file_count', 'byte_count', 'elapsed'])):
+    """
+    Result of VPK.verify_all, failures is a list of VerifyFailure
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    @property
+    def throughput(self):
+        """
+        Verified bytes per second
+        """
+        return self.byte_count / self.elapsed if self.elapsed > 0 else 0.0
 
 
 class VPK(object):
@@ -251,14 +1405,33 @@ class VPK(object):
     tree_length = 0
     header_length = 0
 
-    def __init__(self, vpk_path, read_header_only=True, path_enc='utf-8', fopen=fopen):
+    def __init__(self, vpk_path, read_header_only=True, path_enc='utf-8', fopen=fopen, use_mmap=False,
+                 max_handles=16, index_cache=None, lazy_preload=False):
         self.path_enc = path_enc
         self.fopen = fopen
 
+        # keep the offset of preload data in the tree instead of the data,
+        # VPKFile reads it on first use
+        self.lazy_preload = lazy_preload
+
+        # True for a name.vpk.idx file next to the VPK, or a directory
+        # to keep index caches in, see read_index
+        self.index_cache = index_cache
+
+        # archive handles shared by all VPKFile instances of this VPK
+        self._pool = _ArchivePool(fopen, max_handles)
+
+        # archive path -> read-only mapping, see _get_mapping
+        self.use_mmap = use_mmap
+        self._mappings = {}
+
         # header
         self.tree = None
         self.vpk_path = vpk_path
 
+        # case-insensitive directory trie over self.tree, see _get_trie
+        self._trie = None
+
         self.read_header()
 
         if not read_header_only:
@@ -269,6 +1442,9 @@ class VPK(object):
         return "%s('%s'%s)" % (self.__class__.__name__, self.vpk_path, headonly)
 
     def __iter__(self):
+        if self.tree is None and self.index_cache:
+            self.read_index()
+
         if self.tree is None:
             def path_generator():
                 for path, meta in self.read_index_iter():
@@ -279,6 +1455,9 @@ class VPK(object):
             return iter(self.tree)
 
     def items(self):
+        if self.tree is None and self.index_cache:
+            self.read_index()
+
         if self.tree is None:
             tree = self.read_index_iter()
 
@@ -287,6 +1466,9 @@ class VPK(object):
             return self.tree.items()
 
     def __len__(self):
+        if self.tree is None and self.index_cache:
+            self.read_index()
+
         if self.tree is None:
             length = 0
             for _ in self.read_index_iter():
@@ -300,7 +1482,21 @@ class VPK(object):
         return self
 
     def __exit__(self, type, value, traceback):
-        pass
+        self.close()
+
+    def close(self):
+        """
+        Closes the shared archive handles and releases the archive mappings.
+        Mappings that still have memoryviews exported are left to the garbage collector
+        """
+        self._pool.close()
+        mappings, self._mappings = self._mappings, {}
+
+        for mapping in mappings.values():
+            try:
+                mapping.close()
+            except BufferError:
+                pass
 
     def __getitem__(self, key):
         """
@@ -315,22 +1511,170 @@ class VPK(object):
         metadata = self.get_file_meta(path)
         return self.get_vpkfile_instance(path, metadata)
 
+    def open_file(self, path, mode='rb', buffering=-1, encoding='utf-8', errors=None, newline=None):
+        """
+        Opens a file of the VPK for reading like the builtin open: 'rb'
+        returns an io.BufferedReader (the raw VPKFile with buffering=0), 'r'
+        an io.TextIOWrapper
+        """
+        if mode not in ('r', 'rt', 'rb'):
+            raise ValueError("invalid mode: {}".format(repr(mode)))
+
+        raw = self.get_file(path)
+
+        if buffering == 0:
+            if mode != 'rb':
+                raise ValueError("can't have unbuffered text I/O")
+            return raw
+
+        buffered = io.BufferedReader(raw, buffering if buffering > 1 else io.DEFAULT_BUFFER_SIZE)
+
+        if mode == 'rb':
+            return buffered
+
+        return io.TextIOWrapper(buffered, encoding, errors, newline)
+
     def get_file_meta(self, path):
         """
-        Returns metadata for given file path
+        Returns metadata for given file path, falls back to a case-insensitive
+        lookup like the engine does
         """
         if self.tree is None:
             self.read_index()
 
         if path not in self.tree:
-            raise KeyError("Path doesn't exist")
+            path = self.resolve_path(path)
+            if path is None:
+                raise KeyError("Path doesn't exist")
 
         return self._make_meta_dict(self.tree[path])
 
+    def resolve_path(self, path):
+        """
+        Returns the path as stored in the VPK for a path in any case and with
+        either slash, or None if there is no such file
+        """
+        parts = _normalize_vpk_path(path).lower().split('/')
+        node = self._get_trie()
+
+        for part in parts[:-1]:
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+
+        return node.files.get(parts[-1])
+
+    def listdir(self, path=''):
+        """
+        Returns the names of the files and directories in a VPK directory,
+        case-insensitive. Raises KeyError if it does not exist
+        """
+        node = self._get_trie()
+
+        for part in _normalize_vpk_path(path).lower().split('/'):
+            if part:
+                node = node.dirs.get(part)
+                if node is None:
+                    raise KeyError("Directory doesn't exist")
+
+        return sorted([child.name for child in node.dirs.values()] +
+                      [file_path.rpartition('/')[2] for file_path in node.files.values()])
+
+    def glob(self, pattern):
+        """
+        Returns the sorted VPK paths matching a shell-style pattern, compared
+        case-insensitively. ** matches any number of directories, e.g.
+        glob('maps/*.bsp') or glob('materials/**')
+
+        Only the directories the pattern can reach are visited
+        """
+        parts = [part for part in _normalize_vpk_path(pattern).lower().split('/') if part]
+        matches = set()
+
+        if parts:
+            self._glob(self._get_trie(), parts, matches)
+
+        return sorted(matches)
+
+    def _glob(self, node, parts, matches):
+        part, rest = parts[0], parts[1:]
+
+        if part == '**':
+            if not rest:
+                matches.update(node.walk_files())
+                return
+
+            self._glob(node, rest, matches)
+            for child in node.dirs.values():
+                self._glob(child, parts, matches)
+
+        elif not _GLOB_MAGIC.search(part):
+            if rest:
+                child = node.dirs.get(part)
+                if child is not None:
+                    self._glob(child, rest, matches)
+            elif part in node.files:
+                matches.add(node.files[part])
+
+        else:
+            match = re.compile(fnmatch.translate(part)).match
+            if rest:
+                for name, child in node.dirs.items():
+                    if match(name):
+                        self._glob(child, rest, matches)
+            else:
+                matches.update(path for name, path in node.files.items() if match(name))
+
+    def _get_trie(self):
+        """
+        Returns the root of the directory trie, built from the index on first use
+        """
+        if self.tree is None:
+            self.read_index()
+
+        if self._trie is None:
+            root = _DirNode('')
+
+            for path in self.tree:
+                node = root
+                dirs = path.split('/')
+                name = dirs.pop()
+
+                for part in dirs:
+                    key = part.lower()
+                    child = node.dirs.get(key)
+                    if child is None:
+                        child = node.dirs[key] = _DirNode(part)
+                    node = child
+
+                node.files.setdefault(name.lower(), path)
+
+            self._trie = root
+
+        return self._trie
+
     def get_vpkfile_instance(self, path, metadata):
         if isinstance(metadata, tuple):
             metadata = self._make_meta_dict(metadata)
-        return VPKFile(self._make_vpkfile_path(metadata), filepath=path, fopen=self.fopen, **metadata)
+
+        vpk_path = self._make_vpkfile_path(metadata)
+        mapping = self._get_mapping(vpk_path) if self.use_mmap and metadata['file_length'] else None
+
+        return VPKFile(vpk_path, filepath=path, fopen=self.fopen, mapping=mapping, pool=self._pool,
+                       preload_path=self.vpk_path, **metadata)
+
+    def _get_mapping(self, vpk_path):
+        """
+        Returns a shared read-only mmap of the given archive
+        """
+        mapping = self._mappings.get(vpk_path)
+
+        if mapping is None:
+            with self.fopen(vpk_path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            mapping = self._mappings.setdefault(vpk_path, mapping)
+
+        return mapping
 
     def _make_vpkfile_path(self, metadata):
         path = self.vpk_path
@@ -434,6 +1778,233 @@ class VPK(object):
 
         return tree_checksum.digest(), chunk_hashes_checksum.digest(), file_checksum.digest()
 
+    def read_chunk_hashes(self):
+        """
+        Returns the archive MD5 entries as a list of
+        (archive_index, offset, length, md5) tuples. Only for version 2
+
+        Offsets of archive index 0x7fff are relative to the embedded data
+        """
+        if not self.version == 2:
+            raise ValueError("VPK chunk hashes only supported on version 2")
+
+        with self.fopen(self.vpk_path, 'rb') as f:
+            f.seek(self.header_length + self.tree_length + self.embed_chunk_length)
+            data = f.read(self.chunk_hashes_length)
+
+        return list(_CHUNK_HASH.iter_unpack(data))
+
+    def get_file_chunks(self, path):
+        """
+        Returns the archive MD5 entries covering the data of the given file
+        """
+        metadata = self.get_file_meta(path)
+        archive_index = metadata['archive_index']
+        start = metadata['archive_offset']
+        end = start + metadata['file_length']
+
+        if archive_index == 0x7fff:
+            start -= self.header_length + self.tree_length
+            end -= self.header_length + self.tree_length
+
+        return [chunk for chunk in self.read_chunk_hashes()
+                if chunk[0] == archive_index and chunk[1] < end and chunk[1] + chunk[2] > start]
+
+    def verify_chunk(self, chunk):
+        """
+        Returns True if the data covered by an archive MD5 entry matches it
+        """
+        return not self.verify_chunks([chunk], workers=1)
+
+    def verify_chunks(self, chunks=None, workers=None):
+        """
+        Verifies archive MD5 entries (all of them by default) in parallel,
+        returns the list of entries whose data does not match. Only for version 2
+        """
+        if chunks is None:
+            chunks = self.read_chunk_hashes()
+
+        embed_offset = self.header_length + self.tree_length
+
+        def check(chunk):
+            archive_index, offset, length, digest = chunk
+            path = self._make_vpkfile_path({'archive_index': archive_index})
+            if archive_index == 0x7fff:
+                offset += embed_offset
+            try:
+                return md5(self._pool.read(path, length, offset)).digest() == digest
+            except OSError:
+                return False
+
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+            results = list(executor.map(check, chunks))
+
+        return [chunk for chunk, ok in zip(chunks, results) if not ok]
+
+    def verify_all(self, workers=None, chunk_size=2**20):
+        """
+        Checks the crc32 of every file in parallel and returns a VerifyResult
+
+        Files are checked in (archive_index, archive_offset) order so each
+        archive is read mostly sequentially. Neighbouring files without
+        preload data are read together, up to chunk_size bytes per read
+        """
+        entries = sorted(self.items(), key=lambda item: (item[1][3], item[1][4]))
+
+        # lists of entries checked by one task, runs of small files share one read
+        batches = []
+        span_start = span_end = None
+        for item in entries:
+            metadata = item[1]
+            offset, file_length = metadata[4], metadata[5]
+
+            if metadata[2] or file_length > chunk_size:
+                batches.append([item])
+                span_start = None
+                continue
+
+            if span_start is None or metadata[3] != batches[-1][0][1][3] or \
+                    max(span_end, offset + file_length) - span_start > chunk_size:
+                batches.append([])
+                span_start = span_end = offset
+
+            batches[-1].append(item)
+            span_end = max(span_end, offset + file_length)
+
+        local = threading.local()
+
+        def check_span(batch):
+            metadata = batch[0][1]
+            start = metadata[4]
+            end = max(metadata[4] + metadata[5] for _, metadata in batch)
+
+            try:
+                buf = getattr(local, 'buf', None)
+                if buf is None or len(buf) < end - start:
+                    buf = local.buf = memoryview(bytearray(end - start))
+                size = self._pool.readinto(self._make_vpkfile_path({'archive_index': metadata[3]}),
+                                           buf[:end - start], start)
+            except (OSError, ValueError) as e:
+                return [VerifyFailure(path, metadata[3], metadata[4], metadata[1], None, str(e))
+                        for path, metadata in batch]
+
+            failures = []
+            for path, metadata in batch:
+                offset = metadata[4] - start
+                if offset + metadata[5] > size:
+                    failures.append(VerifyFailure(path, metadata[3], metadata[4], metadata[1], None,
+                                                  "Unexpected end of archive"))
+                    continue
+
+                checksum = crc32(buf[offset:offset + metadata[5]]) & 0xffffffff
+                if checksum != metadata[1]:
+                    failures.append(VerifyFailure(path, metadata[3], metadata[4], metadata[1], checksum, None))
+
+            return failures
+
+        def check_batch(batch):
+            path, metadata = batch[0]
+            if len(batch) > 1 or not (metadata[2] or metadata[5] > chunk_size):
+                return check_span(batch)
+
+            expected = metadata[1]
+            try:
+                f = self.get_vpkfile_instance(path, metadata)
+                try:
+                    checksum = 0
+                    for chunk in f.iter_chunks(chunk_size):
+                        checksum = crc32(chunk, checksum)
+                finally:
+                    f.close()
+            except (OSError, ValueError) as e:
+                return [VerifyFailure(path, metadata[3], metadata[4], expected, None, str(e))]
+
+            checksum &= 0xffffffff
+            if checksum != expected:
+                return [VerifyFailure(path, metadata[3], metadata[4], expected, checksum, None)]
+            return []
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+            failures = [failure for batch_failures in executor.map(check_batch, batches)
+                        for failure in batch_failures]
+        elapsed = time.perf_counter() - start
+
+        byte_count = sum(metadata[2] + metadata[5] for _, metadata in entries)
+
+        return VerifyResult(failures, len(entries), byte_count, elapsed)
+
+    def extract_all(self, dest, filter=None, workers=None, max_memory=2**26, chunk_size=2**20):
+        """
+        Extracts the files for which filter(path) is true (all by default)
+        under dest, returns the number of files written
+
+        Files are extracted in (archive_index, archive_offset) order, each
+        directory is created once, and data is copied with
+        os.copy_file_range where available, otherwise through one chunk_size
+        buffer per worker. workers is capped so the buffers never exceed
+        max_memory
+        """
+        entries = sorted((item for item in self.items() if filter is None or filter(item[0])),
+                         key=lambda item: (item[1][3], item[1][4]))
+
+        dest = os.path.abspath(dest)
+        for path, _ in entries:
+            target = os.path.normpath(os.path.join(dest, path))
+            if os.path.commonpath([dest, target]) != dest:
+                raise ValueError("VPK path escapes the destination: {}".format(repr(path)))
+
+        for relpath in sorted({os.path.dirname(path) for path, _ in entries}):
+            os.makedirs(os.path.join(dest, relpath), exist_ok=True)
+
+        chunk_size = max(1, min(chunk_size, max_memory))
+        workers = max(1, min(workers or min(8, os.cpu_count() or 1), max_memory // chunk_size))
+        local = threading.local()
+
+        def write_all(output, data):
+            view = memoryview(data)
+            while view:
+                view = view[output.write(view):]
+
+        def extract(item):
+            path, metadata = item
+            f = self.get_vpkfile_instance(path, metadata)
+
+            try:
+                with fopen(os.path.join(dest, path), 'wb', buffering=0) as output:
+                    if f._mapping is not None:
+                        for chunk in f.iter_chunks(chunk_size):
+                            write_all(output, chunk)
+                        return
+
+                    if f.preload_length:
+                        write_all(output, f._get_preload())
+
+                    copied = 0
+                    if f.file_length:
+                        copied = f._pool.copy_range(f.vpk_path, output.fileno(), f.archive_offset, f.file_length)
+
+                    # buffered copy of whatever copy_file_range did not do
+                    if copied < f.file_length:
+                        buf = getattr(local, 'buf', None)
+                        if buf is None:
+                            buf = local.buf = memoryview(bytearray(chunk_size))
+
+                        f.seek(f.preload_length + copied)
+                        while True:
+                            size = f.readinto(buf)
+                            if not size:
+                                break
+                            write_all(output, buf[:size])
+            finally:
+                f.close()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(extract, entries):
+                pass
+
+        return len(entries)
+
     def verify(self):
         """
         Verify VPK file. Only for version 2
@@ -449,78 +2020,256 @@ class VPK(object):
     def read_index(self):
         """
         Reads the index and populates the directory tree
+
+        With index_cache the parsed index is loaded from a cache file when
+        the VPK size, mtime and tree checksum still match, and the cache is
+        rebuilt otherwise
         """
         if not isinstance(self.tree, dict):
             self.tree = dict()
 
         self.tree.clear()
+        self._trie = None
+
+        if not self.index_cache or not self.path_enc:
+            for path, metadata in self.read_index_iter():
+                self.tree[path] = metadata
+            return
+
+        tree = self.read_tree()
+        cache_path = self._index_cache_path()
+        key = self._index_cache_key(tree)
+
+        # the cache always holds preload offsets
+        cached = _load_index_cache(cache_path, key, self.path_enc) if key else None
+        if cached is None:
+            cached = dict(self._parse_tree(tree, lazy_preload=True))
+            if key:
+                _save_index_cache(cache_path, key, cached, self.path_enc)
+
+        if not self.lazy_preload:
+            for path, metadata in cached.items():
+                if metadata[2]:
+                    start = metadata[0] - self.header_length
+                    cached[path] = (tree[start:start + metadata[2]],) + metadata[1:]
+
+        self.tree = cached
+
+    def _index_cache_path(self):
+        if self.index_cache is True:
+            return self.vpk_path + '.idx'
+
+        name = md5(os.path.abspath(self.vpk_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.index_cache, name + '.idx')
+
+    def _index_cache_key(self, tree):
+        """
+        Returns (path, size, mtime_ns, tree crc32, tree_length), None when
+        the VPK can not be stat'ed (custom fopen)
+        """
+        try:
+            stat = os.stat(self.vpk_path)
+        except (OSError, TypeError, ValueError):
+            return None
+
+        return (os.path.abspath(self.vpk_path), stat.st_size, stat.st_mtime_ns,
+                crc32(tree) & 0xFFffFFff, self.tree_length)
+
+    def read_compact_index(self):
+        """
+        Returns the index as a VPKIndex, a NumPy structured array plus an
+        interned path table, without building the tree dict. Requires numpy
+        """
+        np = _import_numpy()
+
+        paths = []
+        extensions = {}
+        columns = ([], [], [], [], [], [])
+        intern = sys.intern
+
+        tree = self.tree.items() if self.tree is not None else self._parse_tree(self.read_tree(), lazy_preload=True)
+
+        for path, (preload, checksum, preload_length, archive_index, archive_offset, file_length) in tree:
+            paths.append(intern(path))
+            ext = path.rpartition('.')[2]
+            for column, value in zip(columns, (checksum,
+                                               archive_index,
+                                               archive_offset,
+                                               file_length,
+                                               preload_length,
+                                               extensions.setdefault(ext, len(extensions)),
+                                               )):
+                column.append(value)
+
+        dtype = VPKIndex._get_dtype()
+        entries = np.empty(len(paths), dtype=dtype)
+        for name, column in zip(dtype.names, columns):
+            entries[name] = column
+
+        archive_sizes = {}
+        for archive_index in set(columns[1]):
+            try:
+                archive_sizes[archive_index] = os.path.getsize(self._make_vpkfile_path({'archive_index': archive_index}))
+            except (OSError, TypeError, ValueError):
+                pass
+
+        return VPKIndex(paths, entries, list(extensions), archive_sizes)
+
+    def read_tree(self):
+        """
+        Reads the whole directory tree region in a single read
+        """
+        with self.fopen(self.vpk_path, 'rb') as f:
+            f.seek(self.header_length)
+            tree = f.read(self.tree_length)
+
+        if len(tree) != self.tree_length:
+            raise ValueError("Error parsing index (out of bounds)")
 
-        for path, metadata in self.read_index_iter():
-            self.tree[path] = metadata
+        return tree
 
     def read_index_iter(self):
         """Generator function that reads the file index from the vpk file
 
+        The tree is read into memory once and walked with a memoryview,
+        so parsing costs one read regardless of the number of entries
+
         yeilds (file_path, metadata)
         """
-        _sblank, _sempty, _sdot, _ssep = ((' ', '', '.', '/')
-                                          if self.path_enc else
-                                          (b' ', b'', b'.', b'/'))
+        for entry in self._parse_tree(self.read_tree()):
+            yield entry
 
-        with self.fopen(self.vpk_path, 'rb') as f:
-            f.seek(self.header_length)
+    def _parse_tree(self, tree, lazy_preload=None):
+        """
+        Generator function that parses the directory tree bytes. With
+        lazy_preload (default: self.lazy_preload) the preload item of the
+        metadata is the absolute offset of the preload data in the VPK
 
-            while True:
-                if self.version > 0 and f.tell() > self.tree_length + self.header_length:
+        yeilds (file_path, metadata)
+        """
+        if lazy_preload is None:
+            lazy_preload = self.lazy_preload
+
+        header_length = self.header_length
+        view = memoryview(tree)
+        find = tree.find
+        end = len(tree)
+        path_enc = self.path_enc
+        archive_base = self.header_length + self.tree_length
+        unpack_meta = _ENTRY_META.unpack_from
+        meta_size = _ENTRY_META.size
+
+        if path_enc:
+            def cstring(pos):
+                nul = tree.find(b'\x00', pos)
+                if nul < 0:
+                    raise ValueError("Error parsing index (out of bounds)")
+                try:
+                    return str(view[pos:nul], path_enc, 'strict'), nul + 1
+                except UnicodeDecodeError:
+                    return ' ', nul + 1
+            _sblank, _sempty, _sdot, _ssep = ' ', '', '.', '/'
+        else:
+            def cstring(pos):
+                nul = tree.find(b'\x00', pos)
+                if nul < 0:
                     raise ValueError("Error parsing index (out of bounds)")
+                return tree[pos:nul], nul + 1
+            _sblank, _sempty, _sdot, _ssep = b' ', b'', b'.', b'/'
+
+        pos = 0
+
+        while True:
+            ext, pos = cstring(pos)
+            if not ext:
+                break
 
-                ext = _read_cstring(f, self.path_enc)
-                if not ext:
+            while True:
+                path, pos = cstring(pos)
+                if not path:
                     break
+                if path != _sblank:
+                    path = path + _ssep
+                else:
+                    path = _sempty
 
                 while True:
-                    path = _read_cstring(f, self.path_enc)
-                    if not path:
+                    # inlined cstring(), this is the hot loop
+                    nul = find(b'\x00', pos)
+                    if nul == pos:
+                        pos += 1
                         break
-                    if path != _sblank:
-                        path = path + _ssep
+                    if nul < 0:
+                        raise ValueError("Error parsing index (out of bounds)")
+                    name = tree[pos:nul]
+                    if path_enc:
+                        try:
+                            name = name.decode(path_enc)
+                        except UnicodeDecodeError:
+                            name = ' '
+                    pos = nul + 1
+
+                    if pos + meta_size > end:
+                        raise ValueError("Error parsing index (out of bounds)")
+
+                    (crc32,
+                     preload_length,
+                     archive_index,
+                     archive_offset,
+                     file_length,
+                     suffix,
+                     ) = unpack_meta(tree, pos)
+                    pos += meta_size
+
+                    if suffix != 0xffff:
+                        raise ValueError("Error while parsing index")
+
+                    if archive_index == 0x7fff:
+                        archive_offset += archive_base
+
+                    if pos + preload_length > end:
+                        raise ValueError("Error parsing index (out of bounds)")
+
+                    if not preload_length:
+                        preload = b''
+                    elif lazy_preload:
+                        preload = header_length + pos
                     else:
-                        path = _sempty
-
-                    while True:
-                        name = _read_cstring(f, self.path_enc)
-                        if not name:
-                            break
-
-                        (crc32,
-                         preload_length,
-                         archive_index,
-                         archive_offset,
-                         file_length,
-                         suffix,
-                         ) = metadata = list(struct.unpack("IHHIIH", f.read(18)))
-
-                        if suffix != 0xffff:
-                            raise ValueError("Error while parsing index")
-
-                        if archive_index == 0x7fff:
-                            metadata[3] = self.header_length + self.tree_length + archive_offset
+                        preload = tree[pos:pos + preload_length]
+                    pos += preload_length
+
+                    yield path + name + _sdot + ext, (preload,
+                                                      crc32,
+                                                      preload_length,
+                                                      archive_index,
+                                                      archive_offset,
+                                                      file_length,
+                                                      )
 
-                        metadata = (f.read(preload_length),) + tuple(metadata[:-1])
 
-                        yield path + name + _sdot + ext, metadata
+class VPKFile(io.RawIOBase):
+    """
+    Raw, seekable, read-only file object for files inside VPK. Wrap it in
+    io.BufferedReader / io.TextIOWrapper (see VPK.open_file) for buffered
+    line iteration
 
+    When a mapping (mmap of the archive) is given, reads are served from it
+    and read_view returns memoryview slices of it without copying. Otherwise
+    reads go through pool, which is shared with the other files of the VPK,
+    or through a private single handle pool opened on first read
 
-class VPKFile(object):
-    """
-    File-like object for files inside VPK
+    preload may be the offset of the preload data in preload_path (the
+    _dir.vpk) instead of the data, it is then read on first use
     """
-    _fp = None
+    _pool = None
+    _own_pool = False
     _vpk_path = None
+    _mapping = None
 
-    def __init__(self, vpk_path, fopen=fopen, **kw):
+    def __init__(self, vpk_path, fopen=fopen, mapping=None, pool=None, preload_path=None, **kw):
         self.vpk_path = vpk_path
         self.fopen = fopen
+        self.preload_path = preload_path or vpk_path
         self.vpk_meta = kw
 
         for k, v in kw.items():
@@ -534,9 +2283,28 @@ class VPKFile(object):
         # offset of entire file
         self.offset = 0
 
-        if vpk_path:
-            self._fp = self.fopen(vpk_path, 'rb')
-            self._fp.seek(self.archive_offset)
+        if mapping is not None:
+            self._mapping = memoryview(mapping)[self.archive_offset:self.archive_offset + self.file_length]
+
+        if pool is not None:
+            self._pool = pool
+        elif vpk_path and mapping is None:
+            self._pool = _ArchivePool(fopen, max_handles=1)
+            self._own_pool = True
+
+    def _get_preload(self):
+        """
+        Returns the preload data, reading it first when only its offset is known
+        """
+        if isinstance(self.preload, int):
+            if self._pool is not None:
+                self.preload = self._pool.read(self.preload_path, self.preload_length, self.preload)
+            else:
+                with self.fopen(self.preload_path, 'rb') as f:
+                    f.seek(self.preload)
+                    self.preload = f.read(self.preload_length)
+
+        return self.preload
 
     def save(self, path):
         """
@@ -548,7 +2316,7 @@ class VPKFile(object):
 
         with fopen(path, 'wb') as output:
             output.truncate(self.length)
-            for chunk in iter(lambda: self.read(8192), b''):
+            for chunk in self.iter_chunks():
                 output.write(chunk)
 
         self.seek(pos)
@@ -565,7 +2333,7 @@ class VPKFile(object):
         self.seek(0)
 
         checksum = 0
-        for chunk in iter(lambda: self.read(8192), b''):
+        for chunk in self.iter_chunks():
             checksum = crc32(chunk, checksum)
 
         # restore file pointer
@@ -580,27 +2348,19 @@ class VPKFile(object):
             ', '.join(["%s=%s" % (k, repr(v)) for k, v in self.vpk_meta.items()])
             )
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.close()
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        return self.next()
+    def readable(self):
+        return True
 
-    def next(self):
-        line = self.readline()
-        if line == b'':
-            raise StopIteration
-        return line
+    def seekable(self):
+        return True
 
     def close(self):
-        if self._fp:
-            self._fp.close()
+        if self._own_pool:
+            self._pool.close()
+        if self._mapping is not None:
+            self._mapping.release()
+            self._mapping = None
+        super(VPKFile, self).close()
 
     def tell(self):
         return self.offset
@@ -616,45 +2376,616 @@ class VPKFile(object):
         else:
             raise ValueError("Invalid value for whence")
 
-        self.offset = offset = min(max(offset, 0), self.length)
-        self._fp.seek(self.archive_offset + max(offset - self.preload_length, 0))
+        self.offset = min(max(offset, 0), self.length)
+        return self.offset
+
+    def readline(self, size=-1):
+        """
+        Reads up to and including the next newline, or at most size bytes.
+        Searches the preload data and mapping in place, otherwise reads ahead
+        in doubling steps so long lines stay linear
+        """
+        if size is None or size < 0:
+            size = self.length
+
+        end = min(self.length, self.offset + size)
+        read_ahead = 256
+        line = []
+
+        while self.offset < end:
+            # data[self.offset + base:stop + base] is the next part of the file
+            if self.offset < self.preload_length:
+                data, base, stop = self._get_preload(), 0, min(end, self.preload_length)
+            elif self._mapping is not None:
+                data, base, stop = self._mapping.obj, self.archive_offset - self.preload_length, end
+            else:
+                stop = min(end, self.offset + read_ahead)
+                data = self._pool.read(self.vpk_path, stop - self.offset,
+                                       self.archive_offset + self.offset - self.preload_length)
+                base, stop = -self.offset, self.offset + len(data)
+                read_ahead *= 2
+                if not data:
+                    break
 
-    def readlines(self):
-        return [line for line in self]
+            pos = data.find(b'\n', self.offset + base, stop + base)
+            if pos > -1:
+                stop = pos - base + 1
 
-    def readline(self, a=False):
-        buf = b''
+            line.append(data[self.offset + base:stop + base])
+            self.offset = stop
 
-        for chunk in iter(lambda: self.read(256), b''):
-            pos = chunk.find(b'\n')
             if pos > -1:
-                pos += 1  # include \n
-                buf += chunk[:pos]
-                self.seek(-(len(chunk) - pos), 1)
                 break
 
-            buf += chunk
-
-        return buf
+        return b''.join(line)
 
     def read(self, length=-1):
+        if length is None:
+            length = -1
         if length == 0 or self.offset >= self.length:
             return b''
 
         data = b''
 
         if self.offset <= self.preload_length:
-            data += self.preload[self.offset:self.offset+length if length > -1 else None]
+            data += self._get_preload()[self.offset:self.offset+length if length > -1 else None]
             self.offset += len(data)
             if length > 0:
                 length = max(length - len(data), 0)
 
         if self.file_length > 0 and self.offset >= self.preload_length:
             left = self.file_length - (self.offset - self.preload_length)
-            data += self._fp.read(left if length == -1 else min(left, length))
-            self.offset += left if length == -1 else min(left, length)
+            size = left if length == -1 else min(left, length)
+            start = self.offset - self.preload_length
+            if self._mapping is not None:
+                data += self._mapping[start:start + size]
+            else:
+                data += self._pool.read(self.vpk_path, size, self.archive_offset + start)
+            self.offset += size
 
         return data
 
+    def find(self, sub, start=0, chunk_size=2**20):
+        """
+        Returns the lowest offset of sub in the file at or after start, or
+        -1. Searches the mapping in place, otherwise reads chunk_size bytes at
+        a time. Does not move the file pointer
+        """
+        sub = bytes(sub)
+        start = max(start, 0)
+
+        if not sub or start >= self.length:
+            return start if not sub and start <= self.length else -1
+
+        if self._mapping is not None and start >= self.preload_length:
+            base = self.archive_offset - self.preload_length
+            pos = self._mapping.obj.find(sub, base + start, base + self.length)
+            return pos - base if pos > -1 else -1
+
+        pos = self.offset
+        try:
+            overlap = max(len(sub) - 1, 0)
+            chunk_size = max(chunk_size, len(sub))
+            offset = start
+
+            while offset < self.length:
+                self.seek(offset)
+                chunk = self.read(chunk_size)
+                index = chunk.find(sub)
+                if index > -1:
+                    return offset + index
+                if offset + len(chunk) >= self.length:
+                    break
+                offset += len(chunk) - overlap
+
+            return -1
+        finally:
+            self.seek(pos)
+
+    def read_view(self, length=-1):
+        """
+        Like read, but returns a memoryview. With a mapping the view points
+        straight into the archive, unless the range starts inside preload data
+        """
+        if self._mapping is None or self.offset < self.preload_length:
+            return memoryview(self.read(length))
+
+        start = self.offset - self.preload_length
+        size = self.file_length - start if length < 0 else min(length, self.file_length - start)
+        self.offset += size
+
+        return self._mapping[start:start + size]
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        """
+        Reads up to len(b) bytes into the writable buffer b, returns the count
+        """
+        view = memoryview(b).cast('B')
+        size = min(len(view), self.length - self.offset)
+        pos = 0
+
+        if size <= 0:
+            return 0
+
+        if self.offset < self.preload_length:
+            pos = min(size, self.preload_length - self.offset)
+            view[:pos] = self._get_preload()[self.offset:self.offset + pos]
+            self.offset += pos
+
+        if pos < size:
+            start = self.offset - self.preload_length
+            if self._mapping is not None:
+                view[pos:size] = self._mapping[start:start + size - pos]
+            else:
+                size = pos + self._pool.readinto(self.vpk_path, view[pos:size], self.archive_offset + start)
+            self.offset += size - pos
+
+        return size
+
+    def iter_chunks(self, chunk_size=2**20):
+        """
+        Yields the file contents from the start as memoryviews, zero-copy
+        when backed by a mapping, otherwise through one reused buffer
+
+        note: resets the file pointer
+        """
+        self.seek(0)
+
+        if self._mapping is not None:
+            if self.preload_length:
+                yield memoryview(self._get_preload())
+            for start in range(0, self.file_length, chunk_size):
+                yield self._mapping[start:start + chunk_size]
+            self.seek(self.length)
+            return
+
+        # small files are the common case, a full chunk_size buffer per file costs more than reading them
+        buf = memoryview(bytearray(max(1, min(chunk_size, self.length))))
+        while True:
+            size = self.readinto(buf)
+            if not size:
+                break
+            yield buf[:size]
+
     def write(self, seq):
         raise NotImplementedError("write method is not supported")
+
+
+class AsyncVPK(object):
+    """
+    asyncio wrapper for a VPK. Blocking work runs in executor (the loop's
+    default one when None), at most max_concurrency calls at a time per
+    instance, so one event loop can serve many VPKs
+
+        async with await open_async(path) as pak:
+            async for path in pak:
+                data = await pak.read(path)
+    """
+    def __init__(self, pak, executor=None, max_concurrency=4):
+        self.vpk = pak
+        self.executor = executor
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, repr(self.vpk))
+
+    async def _run(self, func, *args, **kwargs):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def __aiter__(self):
+        await self.read_index()
+        for path in list(self.vpk.tree):
+            yield path
+
+    async def read_index(self):
+        """
+        Reads the index unless it is already loaded
+        """
+        if self.vpk.tree is None:
+            await self._run(self.vpk.read_index)
+
+    async def get_file_meta(self, path):
+        await self.read_index()
+        # a case-insensitive fallback builds the directory trie
+        return await self._run(self.vpk.get_file_meta, path)
+
+    async def read(self, path):
+        """
+        Returns the contents of the file at path
+        """
+        await self.read_index()
+        return await self._run(self._read, path)
+
+    def _read(self, path):
+        with self.vpk.get_file(path) as f:
+            return f.read()
+
+    async def glob(self, pattern):
+        await self.read_index()
+        return await self._run(self.vpk.glob, pattern)
+
+    async def extract_all(self, dest, filter=None, workers=None, max_memory=2**26, chunk_size=2**20):
+        """
+        VPK.extract_all in the executor, see there
+        """
+        return await self._run(self.vpk.extract_all, dest, filter, workers, max_memory, chunk_size)
+
+    async def verify_all(self, workers=None, chunk_size=2**20):
+        """
+        VPK.verify_all in the executor, see there
+        """
+        return await self._run(self.vpk.verify_all, workers, chunk_size)
+
+    async def close(self):
+        await self._run(self.vpk.close)
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required for the compact VPK index")
+    return numpy
+
+
+class VPKIndex(object):
+    """
+    Compact VPK index, returned by VPK.read_compact_index
+
+    paths is the interned path table, entries a NumPy structured array with
+    one row per path (same order) and extensions the extension table that
+    entries['ext'] points into. Offsets of archive index 0x7fff are
+    absolute, as in VPK.tree
+    """
+    _dtype = None
+
+    def __init__(self, paths, entries, extensions, archive_sizes=None):
+        self.paths = paths
+        self.entries = entries
+        self.extensions = extensions
+        # archive_index -> size of the archive file, for find_out_of_bounds
+        self.archive_sizes = archive_sizes or {}
+
+    @classmethod
+    def _get_dtype(cls):
+        if cls._dtype is None:
+            np = _import_numpy()
+            cls._dtype = np.dtype([('crc32', '<u4'),
+                                   ('archive_index', '<u2'),
+                                   ('archive_offset', '<u8'),
+                                   ('file_length', '<u4'),
+                                   ('preload_length', '<u2'),
+                                   ('ext', '<u2'),
+                                   ])
+        return cls._dtype
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return "%s(%d entries)" % (self.__class__.__name__, len(self))
+
+    def size_by_extension(self):
+        """
+        Returns {extension: total bytes}, preload included
+        """
+        np = _import_numpy()
+        sizes = np.bincount(self.entries['ext'],
+                            weights=self.entries['file_length'].astype('f8') + self.entries['preload_length'],
+                            minlength=len(self.extensions))
+
+        return {ext: int(size) for ext, size in zip(self.extensions, sizes)}
+
+    def sorted_by_offset(self):
+        """
+        Returns the entry indexes sorted by (archive_index, archive_offset)
+        """
+        np = _import_numpy()
+        return np.lexsort((self.entries['archive_offset'], self.entries['archive_index']))
+
+    def find_overlaps(self):
+        """
+        Returns (path, other path) pairs of entries whose data ranges overlap.
+        Entries sharing exactly the same range (deduplicated data) are not
+        reported
+        """
+        np = _import_numpy()
+
+        order = self.sorted_by_offset()
+        entries = self.entries[order]
+        data = entries['file_length'] > 0
+        order, entries = order[data], entries[data]
+
+        if len(entries) < 2:
+            return []
+
+        # archives are kept apart by placing each one in its own 2**40 range
+        base = entries['archive_index'].astype('u8') << np.uint64(40)
+        start = base + entries['archive_offset']
+        end = start + entries['file_length']
+
+        max_end = np.maximum.accumulate(end)
+        # index of the entry that set the running max_end
+        owner = np.maximum.accumulate(np.where(end == max_end, np.arange(len(end)), 0))
+
+        shared = (start[1:] == start[:-1]) & (end[1:] == end[:-1])
+        overlapping = np.nonzero((start[1:] < max_end[:-1]) & ~shared)[0] + 1
+
+        return [(self.paths[order[i]], self.paths[order[owner[i - 1]]]) for i in overlapping]
+
+    def find_out_of_bounds(self, archive_sizes=None):
+        """
+        Returns the paths whose data reaches past the end of their archive,
+        or whose archive is missing
+        """
+        np = _import_numpy()
+
+        archive_sizes = self.archive_sizes if archive_sizes is None else archive_sizes
+        lookup = np.full(0x8000, -1, dtype='i8')
+        for archive_index, size in archive_sizes.items():
+            lookup[archive_index] = size
+
+        entries = self.entries
+        limit = lookup[entries['archive_index']]
+        end = entries['archive_offset'].astype('i8') + entries['file_length']
+        bad = (entries['file_length'] > 0) & ((limit < 0) | (end > limit))
+
+        return [self.paths[i] for i in np.nonzero(bad)[0]]
+
+
+class VPKPatcher(object):
+    """
+    Adds, replaces and removes files of an existing version 1 VPK in place
+
+    commit() only appends new data and rewrites the directory tree. Data of
+    replaced or removed files stays in the archives as unused space until
+    compact() rebuilds the VPK. New data of a multi-archive VPK (name_dir.vpk)
+    goes to its last archive, or to a new one once that would grow past
+    max_archive_size
+    """
+    # extra tree space reserved when the tree grows, so that following
+    # commits can usually rewrite it without moving embedded data
+    tree_slack = 4096
+
+    def __init__(self, vpk_path, path_enc='utf-8', max_archive_size=2**31):
+        self.vpk_path = vpk_path
+        self.path_enc = path_enc
+        self.max_archive_size = max_archive_size
+
+        # path -> source, or None for removed files
+        self.changes = {}
+
+        self.vpk = None
+        self._open()
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.vpk_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.vpk.close()
+
+    def _open(self):
+        if self.vpk is not None:
+            self.vpk.close()
+
+        self.vpk = VPK(self.vpk_path, path_enc=self.path_enc)
+
+        if self.vpk.version != 1:
+            raise ValueError("Patching only supported on version 1")
+
+        self.vpk.read_index()
+
+    @property
+    def is_multi_archive(self):
+        return self.vpk_path.endswith('_dir.vpk')
+
+    def add_file(self, vpk_path, source):
+        """
+        Adds or replaces the file at vpk_path, source is anything NewVPK.add_file accepts
+        """
+        vpk_path = vpk_path.replace('\\', '/').strip('/')
+
+        filename, dot, ext = vpk_path.rpartition('/')[2].rpartition('.')
+        if not (filename and dot and ext):
+            raise RuntimeError("Files without a name or an extension are not supported: {0}".format(repr(vpk_path)))
+
+        self.changes[vpk_path] = source
+
+    def remove_file(self, vpk_path):
+        """
+        Removes the file at vpk_path
+        """
+        vpk_path = vpk_path.replace('\\', '/').strip('/')
+
+        if vpk_path not in self.vpk.tree and self.changes.get(vpk_path) is None:
+            raise KeyError("Path doesn't exist")
+
+        if vpk_path in self.vpk.tree:
+            self.changes[vpk_path] = None
+        else:
+            del self.changes[vpk_path]
+
+    def _append_target(self, entries, append_length):
+        """
+        Returns (archive_index, path) of the file new data is appended to
+        """
+        if not self.is_multi_archive:
+            return 0x7fff, self.vpk_path
+
+        archive_indexes = [metadata[2] for metadata in entries.values() if metadata[2] != 0x7fff]
+        archive_index = max(archive_indexes) if archive_indexes else 0
+
+        while os.path.exists(_make_archive_path(self.vpk_path, archive_index + 1)):
+            archive_index += 1
+
+        archive_path = _make_archive_path(self.vpk_path, archive_index)
+        archive_size = os.path.getsize(archive_path) if os.path.exists(archive_path) else 0
+
+        if archive_size and archive_size + append_length > self.max_archive_size:
+            archive_index += 1
+            archive_path = _make_archive_path(self.vpk_path, archive_index)
+
+        return archive_index, archive_path
+
+    def _append(self, archive_path, archive_index, data_base, append_length, relocate, added, entries):
+        """
+        Appends the relocated and the added data to archive_path and updates
+        their entries. The archive is restored when anything fails
+        """
+        pak = self.vpk
+        exists = os.path.exists(archive_path)
+        start = os.path.getsize(archive_path) if exists else 0
+
+        if archive_index == 0x7fff:
+            # embedded data starts after the tree, which may have grown past the end of a small VPK
+            start = max(start, data_base)
+            if start + append_length - data_base > 0xFFFFFFFF:
+                raise ValueError("VPK data exceeds 4 GiB")
+        elif start + append_length > 0xFFFFFFFF:
+            raise ValueError("Archive exceeds 4 GiB, lower max_archive_size")
+
+        out = fopen(archive_path, 'r+b' if exists else 'w+b')
+        end = out.seek(0, 2)
+
+        try:
+            out.seek(start)
+
+            for (offset, length), paths in relocate.items():
+                position = out.tell()
+                for chunk_start in range(offset, offset + length, 2**20):
+                    out.write(pak._pool.read(pak.vpk_path, min(2**20, offset + length - chunk_start), chunk_start))
+                for path in paths:
+                    entries[path][2:4] = [archive_index, position]
+
+            for path, source, file_length in added:
+                position = out.tell()
+                checksum, copied = _copy_source(source, out)
+                if copied != file_length:
+                    raise RuntimeError("File changed while saving: {0}".format(repr(source)))
+                entries[path] = [checksum, b'', archive_index, position, file_length]
+        except BaseException:
+            out.truncate(end)
+            out.close()
+            if not exists:
+                os.remove(archive_path)
+            raise
+
+        out.close()
+
+    def commit(self):
+        """
+        Writes the pending changes to the VPK
+        """
+        if not self.changes:
+            return
+
+        pak = self.vpk
+        enc = self.path_enc
+
+        # path -> [crc32, preload, archive_index, archive_offset, file_length],
+        # embedded (0x7fff) offsets are absolute while patching
+        entries = {}
+        for path, (preload, checksum, preload_length, archive_index, archive_offset, file_length) in pak.tree.items():
+            if path not in self.changes:
+                entries[path] = [checksum, preload, archive_index, archive_offset, file_length]
+
+        # lengths are needed up front, so that nothing is written before all checks pass
+        added = []
+        for path, source in self.changes.items():
+            if source is not None:
+                source, file_length = _sized_source(source)
+                if file_length > 0xFFFFFFFF:
+                    raise ValueError("Files over 4 GiB are not supported")
+                added.append((path, source, file_length))
+                entries[path] = [0, b'', 0x7fff, 0, 0]
+
+        tree_length = len(_pack_tree_entries(entries, enc))
+        if tree_length <= pak.tree_length:
+            tree_length = pak.tree_length
+        else:
+            tree_length += self.tree_slack
+
+        data_base = pak.header_length + tree_length
+
+        # embedded data the grown tree would overwrite is appended again
+        relocate = {}
+        for path, metadata in entries.items():
+            if metadata[2] == 0x7fff and metadata[4] and path not in self.changes and metadata[3] < data_base:
+                relocate.setdefault((metadata[3], metadata[4]), []).append(path)
+
+        append_length = sum(length for offset, length in relocate) + \
+            sum(file_length for path, source, file_length in added)
+        archive_index, archive_path = self._append_target(entries, append_length)
+
+        if relocate or added:
+            self._append(archive_path, archive_index, data_base, append_length, relocate, added, entries)
+
+        # embedded data is released before the dir file is rewritten
+        pak.close()
+
+        for metadata in entries.values():
+            if metadata[2] == 0x7fff:
+                metadata[3] -= data_base
+
+        tree = _pack_tree_entries(entries, enc)
+
+        with fopen(self.vpk_path, 'r+b') as f:
+            f.write(struct.pack("3I", pak.signature, pak.version, tree_length))
+            f.seek(pak.header_length)
+            f.write(tree + b"\x00" * (tree_length - len(tree)))
+
+            if self.is_multi_archive and not any(metadata[2] == 0x7fff and metadata[4] for metadata in entries.values()):
+                f.truncate()
+
+        self.changes = {}
+        self._open()
+
+    def compact(self, workers=None, dedup=True):
+        """
+        Commits pending changes and rebuilds the VPK without unused space
+        """
+        self.commit()
+
+        new_pack = NewVPK(path_enc=self.path_enc)
+        new_pack.add_vpk(self.vpk)
+
+        base = self.vpk_path[:-len('_dir.vpk')] if self.is_multi_archive else os.path.splitext(self.vpk_path)[0]
+        temp_path = base + '_compact_tmp.vpk'
+
+        if self.is_multi_archive:
+            written = new_pack.save(temp_path, max_archive_size=self.max_archive_size, workers=workers, dedup=dedup)
+        else:
+            written = new_pack.save(temp_path, workers=workers, dedup=dedup)
+
+        self.vpk.close()
+
+        if self.is_multi_archive:
+            archive_index = 0
+            while os.path.exists(_make_archive_path(self.vpk_path, archive_index)):
+                os.remove(_make_archive_path(self.vpk_path, archive_index))
+                archive_index += 1
+
+            os.replace(written[0], self.vpk_path)
+            for archive_index, path in enumerate(written[1:]):
+                os.replace(path, _make_archive_path(self.vpk_path, archive_index))
+        else:
+            os.replace(written[0], self.vpk_path)
+
+        self._open()
@@ -10,6 +10,7 @@ import zipfile
 import py7zr
 import rarfile
 import l4d2_vpk_lib as vpk
+from tracing import REPORT_ENV, ResourceMonitor, Tracer
 import sys
 from datetime import datetime
 import configparser
@@ -20,11 +21,16 @@ import requests
 from packaging import version
 import traceback
 import itertools
+import mmap
 from help_module import show_help, show_update_log, report_error, about_this
 
 CURRENT_VERSION = "1.0.8"
 UPDATE_CHECK_URL = "https://api.github.com/repos/Mineralcr/l4d2_Map_Tools/releases/latest"
 CONFIG_FILE = "map_tools_config.ini"
+# threads reading files and computing CRCs ahead of the VPK writer
+VPK_SAVE_WORKERS = min(8, os.cpu_count() or 1)
+# marker of the string table dictionary packed into a BSP
+DICTIONARY_PATTERN = b"\x73\x74\x72\x69\x6E\x67\x74\x61\x62\x6C\x65\x5F\x64\x69\x63\x74\x69\x6F\x6E\x61\x72\x79\x2E\x64\x63\x74\x50\x4B"
 
 
 class UpdateChecker(QThread):
@@ -114,7 +120,8 @@ class MapBuilder:
             raise ValueError("未选择left4dead2.exe 路径")
         
         target_path = os.path.join(self.l4d2_maps_path, self.file_name)
-        shutil.copy2(self.original_bsp_path, target_path)
+        # the game rebuilds the map in place, so it must not share the original's data
+        stage_file(self.original_bsp_path, target_path, link=False)
         map_name = self.file_name.replace(".bsp", "")
         return target_path, map_name
 
@@ -137,9 +144,8 @@ class MapBuilder:
     def _restore_map_file(self, target_path):
         current_time2 = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         if os.path.getsize(target_path) != os.path.getsize(self.original_bsp_path):
-            shutil.copy2(target_path, self.original_bsp_path)
+            move_file(target_path, self.original_bsp_path)
             self.dict_exist_signal.emit(f"Progress:[{current_time2}] 反射和字典重建完成...")
-            os.remove(target_path)
             return True
         else:
             self.dict_exist_signal.emit(f"Progress:[{current_time2}] 反射和字典重建失败!请尝试手动重建!")
@@ -186,11 +192,83 @@ def remove_directory_with_retries(file_path, max_retries=5):
             return True
     return False
 
+
+# files the dedicated server does not need, left out of the server VPK
+SERVER_STRIP_EXTENSIONS = ('.vtf', '.mp3', '.wav', '.vmf', '.vmx')
+
+
+def is_server_stripped(vpk_path):
+    name = vpk_path.replace('\\', '/').rpartition('/')[2]
+    return '.' not in name or name.lower().endswith(SERVER_STRIP_EXTENSIONS)
+
+
+def is_server_kept(vpk_path):
+    # read_dir skips CJK file names, files taken straight from a VPK follow the same rule
+    return not is_server_stripped(vpk_path) and not vpk.has_cjk_name(vpk_path)
+
+
+def is_client_only(vpk_path):
+    # the files a client VPK has on top of the server ones
+    return is_server_stripped(vpk_path) and not vpk.has_cjk_name(vpk_path)
+
+
+# Linux ioctl cloning the extents of one file into another (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+
+def stage_file(src, dst, link=True):
+    """
+    Puts a copy of src at dst without copying the data where the filesystem
+    allows it: a hardlink when link is True, else a reflink, else a plain
+    copy. A hardlink shares the data with src, only pass link=True when
+    neither file is rewritten in place afterwards. Returns the method used
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if link:
+        try:
+            os.link(src, dst)
+            return "link"
+        except OSError:
+            pass
+
+    if sys.platform.startswith('linux'):
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except OSError:
+            if os.path.lexists(dst):
+                os.remove(dst)
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def move_file(src, dst):
+    """
+    Moves src over dst, renaming when both are on the same filesystem and
+    copying over dst in place otherwise
+    """
+    try:
+        os.replace(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+        os.remove(src)
+
 class FileProcessor(QThread):
     progress_signal = pyqtSignal(int)
     message_signal = pyqtSignal(str)
     dict_exist_signal = pyqtSignal(str)
-    finished_signal = pyqtSignal(bool, bool)
+    finished_signal = pyqtSignal(bool, bool, dict)
     confirm_signal = pyqtSignal(str)
 
     def __init__(self, input_path, rename_path, output_path, output_type, check_dictionary, bsp_path, auto_compress_dict,
@@ -204,25 +282,58 @@ class FileProcessor(QThread):
         self.bsp_path = bsp_path
         self.temp_dir = os.path.join(self.output_path, "temp_vpk")
         self.temp_dir_file = os.path.join(self.output_path, "temp_vpk_file")
-        self.temp_client_dir_file = os.path.join(self.output_path, "temp_vpk_client_file")
         self.auto_compress_dict = auto_compress_dict
         self.main_window = main_window
         self.launch_options = main_window.launch_options
         self.client_output_path = None
         self.process_type = False
         self.part_client_output_path_array = []
+        # VPKs extracted to temp_dir_file, without the server-stripped files
+        self.exported_vpks = []
+        # I/O per stage, peak RSS and peak temp size of the job, saved when
+        # L4D2_MAP_TOOLS_REPORT names a file, see finish_report
+        self.monitor = ResourceMonitor([self.temp_dir, self.temp_dir_file, self.rename_path])
+        # stage spans, written when L4D2_MAP_TOOLS_TRACE names a file
+        self.tracer = Tracer.from_env(monitor=self.monitor)
 
     def emit_same_message(self, message):
         self.message_signal.emit(message)
         self.dict_exist_signal.emit(message)
 
+    def emit_dedup_message(self, new_pack):
+        if new_pack.duplicate_count:
+            current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S")
+            self.dict_exist_signal.emit(
+                f"[{current_time}]{new_pack.duplicate_count} 个重复文件已合并, 节省 {new_pack.saved_bytes / 1024 / 1024:.2f} MB")
+
+    def finish_report(self):
+        self.monitor.stop()
+        report = self.monitor.report()
+
+        report_path = os.environ.get(REPORT_ENV)
+        if report_path:
+            try:
+                report["path"] = self.monitor.save(report_path)
+            except OSError:
+                pass
+
+        current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S")
+        self.dict_exist_signal.emit(
+            f"[{current_time}]资源统计: 读取 {report['read_bytes'] / 1024 / 1024:.1f} MB, "
+            f"写入 {report['write_bytes'] / 1024 / 1024:.1f} MB, "
+            f"内存峰值 {report['peak_rss'] / 1024 / 1024:.1f} MB, "
+            f"临时文件峰值 {report['peak_temp_bytes'] / 1024 / 1024:.1f} MB")
+        return report
+
     def run(self):
+        self.monitor.start()
         try:
             if self.input_path.lower().endswith(('.zip',  '.7z', '.rar')):
                 current_time = datetime.now().strftime("%Y-%m-%d    %H:%M:%S")
                 message = f"[{current_time}]正在解压文件..."
                 self.emit_same_message(message) 
-                self.extract_archive() 
+                with self.tracer.span("extract_archive", archive=os.path.basename(self.input_path)):
+                    self.extract_archive() 
                 vpk_files = [
                     os.path.join(root,  f)
                     for root, dirs, files in os.walk(self.temp_dir) 
@@ -254,47 +365,101 @@ class FileProcessor(QThread):
                 else:
                     os.makedirs(self.temp_dir_file) 
 
-            if not os.listdir(self.temp_dir_file): 
+            # a single VPK whose maps all have their dictionary is written
+            # straight to the server VPK, without extracting it
+            transcoded = self.input_path.lower().endswith('.vpk') and self.transcode_vpk()
+
+            if not transcoded and not os.listdir(self.temp_dir_file): 
                 thread = threading.Thread(target=self.export_vpk_files,  args=(self.input_path,))  
                 thread.start()  
                 thread.join()
 
-            current_time = datetime.now().strftime("%Y-%m-%d    %H:%M:%S")
-            message = f"[{current_time}]正在处理VPK文件..."
-            self.emit_same_message(message) 
-            self.process_vpk() 
+            if not transcoded:
+                current_time = datetime.now().strftime("%Y-%m-%d    %H:%M:%S")
+                message = f"[{current_time}]正在处理VPK文件..."
+                self.emit_same_message(message) 
+                with self.tracer.span("process_vpk"):
+                    self.process_vpk() 
             remove_directory_with_retries(self.rename_path)
 
             if self.output_type != "vpk": 
                 current_time = datetime.now().strftime("%Y-%m-%d    %H:%M:%S")
                 message = f"[{current_time}]正在压缩文件..."
                 self.emit_same_message(message) 
-                self.compress_output() 
+                with self.tracer.span("compress_output"):
+                    self.compress_output() 
 
             current_time = datetime.now().strftime("%Y-%m-%d    %H:%M:%S")
             message = f"[{current_time}]处理完成！"
             self.emit_same_message(message) 
-            self.finished_signal.emit(True, self.process_type) 
+            self.finished_signal.emit(True, self.process_type, self.finish_report()) 
 
         except Exception as e: 
             current_time = datetime.now().strftime("%Y-%m-%d     %H:%M:%S") 
             message = f"[{current_time}]错误: {str(e)}" 
             self.emit_same_message(message)  
-            self.finished_signal.emit(False, self.process_type)  
+            self.finished_signal.emit(False, self.process_type, self.finish_report())  
         finally: 
             remove_directory_with_retries(self.temp_dir)
             remove_directory_with_retries(self.rename_path)
             remove_directory_with_retries(self.temp_dir_file)
-            remove_directory_with_retries(self.temp_client_dir_file)
+            self.tracer.save()
     
     def export_vpk_files(self, vpk_file): 
-        original_vpk = vpk.open(vpk_file)  
-        for file_path in original_vpk: 
-            file = original_vpk.get_file(file_path)  
-            dest_path = os.path.join(self.temp_dir_file,  file_path) 
-            os.makedirs(os.path.dirname(dest_path),  exist_ok=True) 
-            with open(dest_path, 'wb') as f: 
-                f.write(file.read()) 
+        with self.tracer.span("export_vpk", vpk=os.path.basename(vpk_file)), \
+                vpk.open(vpk_file, use_mmap=True) as original_vpk:
+            # textures and sounds are only extracted again for a client VPK
+            original_vpk.extract_all(self.temp_dir_file, filter=is_server_kept, workers=VPK_SAVE_WORKERS)
+        self.exported_vpks.append(vpk_file)
+
+    def transcode_vpk(self):
+        """
+        Writes the server VPK straight from self.input_path, copying the kept
+        entries from the source VPK. Returns False without writing anything
+        when a map is missing its dictionary, process_vpk handles those
+        """
+        with self.tracer.span("transcode_vpk", vpk=os.path.basename(self.input_path)), \
+                vpk.open(self.input_path, use_mmap=True) as original_vpk:
+            if self.check_dictionary:
+                if not original_vpk.glob('maps/**'):
+                    current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S")
+                    message = f"[{current_time}]警告：未找到maps文件夹"
+                    self.emit_same_message(message)
+
+                bsp_files = original_vpk.glob('maps/**/*.bsp')
+                for bsp_file in bsp_files:
+                    with self.tracer.span("bsp_dictionary_scan", bsp=bsp_file), \
+                            original_vpk.get_file(bsp_file) as file:
+                        if file.find(DICTIONARY_PATTERN) < 0:
+                            return False
+
+                for bsp_file in bsp_files:
+                    current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S")
+                    self.dict_exist_signal.emit(f"[{current_time}]地图名称: {bsp_file.rpartition('/')[2]}, 字典存在,安全!")
+
+                current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S")
+                message = f"[{current_time}]字典检测完成,没有发现缺少字典的小图"
+                self.process_type = True
+                self.emit_same_message(message)
+
+            current_time = datetime.now().strftime("%Y-%m-%d    %H:%M:%S")
+            message = f"[{current_time}]正在处理VPK文件..."
+            self.emit_same_message(message)
+            self.progress_signal.emit(50)
+
+            base_name = os.path.splitext(os.path.basename(self.input_path))[0]
+            output_vpk = os.path.join(self.output_path, f"{base_name}_server.vpk")
+
+            with self.tracer.span("server_save", vpk=os.path.basename(output_vpk)):
+                new_pack = vpk.new()
+                new_pack.add_vpk(original_vpk, filter=is_server_kept)
+                new_pack.save(output_vpk, workers=VPK_SAVE_WORKERS, dedup=True)
+            self.emit_dedup_message(new_pack)
+
+        self.part_client_output_path_array = [output_vpk]
+        self.output_path = output_vpk
+        self.progress_signal.emit(100)
+        return True
 
     def extract_archive(self):
         if os.path.exists(self.temp_dir):
@@ -317,8 +482,8 @@ class FileProcessor(QThread):
 
     def process_vpk(self): 
         self.progress_signal.emit(30)  
-        if os.path.exists(self.temp_dir):  
-            remove_directory_with_retries(self.temp_dir)  
+        # maps missing their dictionary, a client VPK is only built when there are any
+        b = 0
         if self.check_dictionary:  
             bsp_files = [] 
             maps_dir = os.path.join(self.temp_dir_file,  "maps") 
@@ -332,59 +497,69 @@ class FileProcessor(QThread):
                 message = f"[{current_time}]警告：未找到maps文件夹" 
                 self.emit_same_message(message)  
     
-            b = 0 
             d = 0 
             for bsp_file in bsp_files: 
-                with open(bsp_file, 'rb') as file: 
-                    content = file.read()  
-                    pattern = b"\x73\x74\x72\x69\x6E\x67\x74\x61\x62\x6C\x65\x5F\x64\x69\x63\x74\x69\x6F\x6E\x61\x72\x79\x2E\x64\x63\x74\x50\x4B" 
-                    offset = content.find(pattern)  
-                    dname = os.path.splitext(os.path.basename(bsp_file))[0]  
+                pattern = DICTIONARY_PATTERN 
+                # map the BSP instead of reading it, the file is closed again before
+                # MapBuilder moves the rebuilt map over it, which fails on open files on Windows
+                with self.tracer.span("bsp_dictionary_scan", bsp=os.path.basename(bsp_file)):
+                    # an empty file cannot be mapped, and has no dictionary either
+                    if os.path.getsize(bsp_file) == 0:
+                        offset = -1
+                    else:
+                        with open(bsp_file, 'rb') as file, \
+                                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                            offset = content.find(pattern)
+                dname = os.path.splitext(os.path.basename(bsp_file))[0]  
+    
+                if offset >= 0: 
+                    current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
+                    message = f"[{current_time}]地图名称: {dname}.bsp, 字典存在,安全!" 
+                    self.dict_exist_signal.emit(message)  
+                else: 
+                    if self.auto_compress_dict:  
+                        exe_path = self.main_window.get_l4d2_exe_path(use_config=True)  
+                        if not exe_path: 
+                            raise Exception("用户取消选择exe路径") 
     
-                    if offset >= 0: 
                         current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
-                        message = f"[{current_time}]地图名称: {dname}.bsp, 字典存在,安全!" 
-                        self.dict_exist_signal.emit(message)  
+                        message = f"[{current_time}]地图名称: {dname}.bsp, 字典缺失，正在进行处理!" 
+                        self.emit_same_message(message)  
+                        builder = MapBuilder(bsp_file, exe_path, self.dict_exist_signal)  
+                        with self.tracer.span("MapBuilder", bsp=dname):
+                            built = builder.start_dictionary_process(self.launch_options)
+                        if built:  
+                            d += 1 
+                        b += 1 
                     else: 
-                        if self.auto_compress_dict:  
+                        event = threading.Event() 
+                        def on_confirm_reply(): 
+                            event.set()  
+        
+                        self.confirm_signal.connect(self.main_window.show_confirm_dialog)  
+                        self.main_window.confirm_signal_received = on_confirm_reply 
+                        self.confirm_signal.emit(bsp_file)  
+        
+                        event.wait()  
+        
+                        result = self.main_window.confirm_result  
+                        if result == QMessageBox.No or result == QMessageBox.Cancel: 
+                            continue 
+                        else:
                             exe_path = self.main_window.get_l4d2_exe_path(use_config=True)  
                             if not exe_path: 
                                 raise Exception("用户取消选择exe路径") 
     
+                            self.auto_compress_dict  = True 
                             current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
                             message = f"[{current_time}]地图名称: {dname}.bsp, 字典缺失，正在进行处理!" 
                             self.emit_same_message(message)  
-                            builder = MapBuilder(bsp_file, exe_path, self.dict_exist_signal)  
-                            if builder.start_dictionary_process(self.launch_options):  
+                            builder = MapBuilder(bsp_file, exe_path, self.dict_exist_signal) 
+                            with self.tracer.span("MapBuilder", bsp=dname):
+                                built = builder.start_dictionary_process(self.launch_options)
+                            if built:  
                                 d += 1 
                             b += 1 
-                        else: 
-                            event = threading.Event() 
-                            def on_confirm_reply(): 
-                                event.set()  
-        
-                            self.confirm_signal.connect(self.main_window.show_confirm_dialog)  
-                            self.main_window.confirm_signal_received = on_confirm_reply 
-                            self.confirm_signal.emit(bsp_file)  
-        
-                            event.wait()  
-        
-                            result = self.main_window.confirm_result  
-                            if result == QMessageBox.No or result == QMessageBox.Cancel: 
-                                continue 
-                            else:
-                                exe_path = self.main_window.get_l4d2_exe_path(use_config=True)  
-                                if not exe_path: 
-                                    raise Exception("用户取消选择exe路径") 
-    
-                                self.auto_compress_dict  = True 
-                                current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
-                                message = f"[{current_time}]地图名称: {dname}.bsp, 字典缺失，正在进行处理!" 
-                                self.emit_same_message(message)  
-                                builder = MapBuilder(bsp_file, exe_path, self.dict_exist_signal) 
-                                if builder.start_dictionary_process(self.launch_options):  
-                                    d += 1 
-                                b += 1 
     
             if b == 0: 
                 current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
@@ -405,88 +580,24 @@ class FileProcessor(QThread):
                     f"{os.path.splitext(os.path.basename(self.input_path))[0]}_client.vpk"  
                 )  
     
-                shutil.copytree(self.temp_dir_file,  self.temp_client_dir_file)  
-            
-                def get_folder_size(folder): 
-                    total_size = 0 
-                    for path, dirs, files in os.walk(folder):  
-                        for f in files: 
-                            fp = os.path.join(path,  f) 
-                            total_size += os.path.getsize(fp)  
-                    return total_size 
-            
-                max_size = 1.5 * 1024 * 1024 * 1024  # 1.5GB 
-                folder_size = get_folder_size(self.temp_client_dir_file)  
-            
-                if folder_size > max_size: 
-                    def split_folder(folder, max_size): 
-                        file_list = [] 
-                        for root, dirs, files in os.walk(folder):  
-                            for file in files: 
-                                file_path = os.path.join(root,  file) 
-                                file_list.append((file_path,  os.path.getsize(file_path)))  
-                        file_list.sort(key=lambda  x: x[1], reverse=True) 
-            
-                        part_index = 1 
-                        current_size = 0 
-                        current_part_files = [] 
-                        part_folders = [] 
-            
-                        for file_path, file_size in file_list: 
-                            if current_size + file_size > max_size: 
-                                part_folder = f"{self.temp_client_dir_file}_{part_index}"  
-                                os.makedirs(part_folder,  exist_ok=True) 
-                                for src_file in current_part_files: 
-                                    dest_file = os.path.join(part_folder,  os.path.relpath(src_file,  folder)) 
-                                    os.makedirs(os.path.dirname(dest_file),  exist_ok=True) 
-                                    shutil.copy2(src_file,  dest_file) 
-                                part_folders.append(part_folder)  
-                                current_part_files = [] 
-                                current_size = 0 
-                                part_index += 1 
-                            current_size += file_size 
-                            current_part_files.append(file_path)  
-            
-                        if current_part_files: 
-                            part_folder = f"{self.temp_client_dir_file}_{part_index}"  
-                            os.makedirs(part_folder,  exist_ok=True) 
-                            for src_file in current_part_files: 
-                                dest_file = os.path.join(part_folder,  os.path.relpath(src_file,  folder)) 
-                                os.makedirs(os.path.dirname(dest_file),  exist_ok=True) 
-                                shutil.copy2(src_file,  dest_file) 
-                            part_folders.append(part_folder)  
-            
-                        return part_folders 
-            
-                    part_folders = split_folder(self.temp_client_dir_file,  max_size) 
-                    for i, part_folder in enumerate(part_folders, start=1): 
-                        part_client_output_path = os.path.join(  
-                            self.output_path,  
-                            f"{os.path.splitext(os.path.basename(self.input_path))[0]}_client_{i}.vpk"  
-                        ) 
-                        vpk.new(part_folder).save(part_client_output_path)  
-                        self.part_client_output_path_array.append(part_client_output_path) 
-                        remove_directory_with_retries(part_folder) 
-                else: 
-                    vpk.new(self.temp_client_dir_file).save(self.client_output_path)  
-                    self.part_client_output_path_array.append(self.client_output_path) 
+                server_output_path = os.path.join(
+                    self.output_path,
+                    f"{os.path.splitext(os.path.basename(self.input_path))[0]}_server.vpk"
+                )
+                self.save_client_and_server(server_output_path)
             
                 self.output_path  = self.client_output_path  
                 if self.output_type  != "vpk": 
-                    self.compress_output()
-    
-                if os.path.exists(self.temp_client_dir_file):  
-                    remove_directory_with_retries(self.temp_client_dir_file)  
+                    with self.tracer.span("compress_output", part="client"):
+                        self.compress_output()
     
+        # kept until here, the client build extracts the stripped files from the VPKs in it
+        if os.path.exists(self.temp_dir):  
+            remove_directory_with_retries(self.temp_dir)  
+
         current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
         message = f"[{current_time}]正在进行地图服务端无用资源清洗.." 
         self.emit_same_message(message)  
-        for root, dirs, files in os.walk(self.temp_dir_file):  
-            for file in files: 
-                if '.' not in os.path.basename(file)  or file.lower().endswith(('.vtf',  '.mp3', '.wav', '.vmf', '.vmx')): 
-                    file_path = os.path.join(root,  file) 
-                    os.remove(file_path)  
-    
         current_time = datetime.now().strftime("%Y-%m-%d  %H:%M:%S") 
         message = f"[{current_time}]地图服务端无用资源清洗完毕.." 
         self.emit_same_message(message)  
@@ -499,8 +610,13 @@ class FileProcessor(QThread):
         else: 
             output_vpk = os.path.join(os.path.dirname(self.output_path),  f"{base_name}_server.vpk")  
     
-        new_pack = vpk.new(self.temp_dir_file)  
-        new_pack.save(output_vpk)
+        # with a client VPK, save_client_and_server already wrote it
+        if b == 0:
+            with self.tracer.span("server_save", vpk=os.path.basename(output_vpk)):
+                # stripped files are not extracted, the filter also covers anything else in the folder
+                new_pack = vpk.new(self.temp_dir_file, exclude=is_server_stripped)  
+                new_pack.save(output_vpk, workers=VPK_SAVE_WORKERS, dedup=True)
+            self.emit_dedup_message(new_pack)
         self.part_client_output_path_array = []
         self.part_client_output_path_array.append(output_vpk)  
     
@@ -508,6 +624,45 @@ class FileProcessor(QThread):
         self.progress_signal.emit(100)  
  
 
+    def save_client_and_server(self, server_output_path):
+        """
+        Writes the client VPK (every file, split into standalone VPKs above
+        1.5GB) and the server VPK (the files it keeps) in one pass over the
+        map: the kept files come from temp_dir_file, the stripped ones
+        straight from the source VPKs
+        """
+        max_size = 1.5 * 1024 * 1024 * 1024  # 1.5GB 
+        original_vpks = []
+
+        try:
+            with self.tracer.span("client_server_save"):
+                pack = vpk.new(self.temp_dir_file, exclude=is_server_stripped)
+                for vpk_file in self.exported_vpks:
+                    original_vpks.append(vpk.open(vpk_file))
+                    pack.add_vpk(original_vpks[-1], filter=is_client_only)
+
+                # above max_size the client is split into standalone VPKs, each
+                # one installable as its own addon
+                client_parts = pack.partition(max_size)
+                if len(client_parts) > 1:
+                    base_name = os.path.splitext(os.path.basename(self.client_output_path))[0]
+                    outputs = [(os.path.join(os.path.dirname(self.client_output_path), f"{base_name}_{i}.vpk"),
+                                part.__contains__, None)
+                               for i, part in enumerate(client_parts, start=1)]
+                else:
+                    outputs = [(self.client_output_path, None, None)]
+                outputs.append((server_output_path, is_server_kept, None))
+
+                results = pack.save_tee(outputs, workers=VPK_SAVE_WORKERS, dedup=True)
+        finally:
+            for original_vpk in original_vpks:
+                original_vpk.close()
+
+        for client_pack, client_paths in results[:-1]:
+            self.part_client_output_path_array.extend(client_paths)
+            self.emit_dedup_message(client_pack)
+        self.emit_dedup_message(results[-1][0])
+
     def compress_output(self):
         base_name = os.path.splitext(os.path.basename(self.output_path))[0]
         output_file = ""
@@ -898,7 +1053,7 @@ class MainWindow(QMainWindow):
                                     return
                             
                             try:
-                                shutil.copy2(file_path, new_path)
+                                stage_file(file_path, new_path)
                                 QMessageBox.information(
                                     self, 
                                     "重命名成功", 
@@ -981,7 +1136,7 @@ class MainWindow(QMainWindow):
         self.worker.start()  
         self.process_btn.setEnabled(False)
  
-    def on_process_finished(self, success, dict): 
+    def on_process_finished(self, success, dict, report=None): 
         self.progress_bar.setVisible(False)  
         self.process_btn.setEnabled(True)  
  
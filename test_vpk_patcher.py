@@ -0,0 +1,163 @@
+"""
+Round-trip tests for l4d2_vpk_lib.VPKPatcher
+
+    python -m unittest test_vpk_patcher
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import l4d2_vpk_lib as vpk
+
+
+class VPKPatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix="vpk_patch_")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def make_vpk(self, files, name="pak.vpk", max_archive_size=None):
+        pack = vpk.new()
+        for path, data in files.items():
+            pack.add_file(path, data)
+        return pack.save(os.path.join(self.folder, name), max_archive_size=max_archive_size)[0]
+
+    def assert_contents(self, vpk_path, files):
+        with vpk.open(vpk_path) as pak:
+            self.assertEqual(sorted(pak), sorted(files))
+            for path, data in files.items():
+                with pak.get_file(path) as f:
+                    self.assertEqual(f.read(), data, path)
+                    self.assertTrue(f.verify(), path)
+
+    def test_grow_tree_of_small_vpk(self):
+        files = {"scripts/a.txt": b"hello"}
+        vpk_path = self.make_vpk(files)
+
+        with vpk.patch(vpk_path) as patcher:
+            for i in range(5):
+                path = "materials/props_%d/prop.vmt" % i
+                files[path] = b"data %d" % i
+                patcher.add_file(path, files[path])
+            patcher.commit()
+
+        self.assert_contents(vpk_path, files)
+
+    def test_grow_tree_relocates_embedded_data(self):
+        files = {"scripts/%d.txt" % i: os.urandom(100 + i) for i in range(20)}
+        vpk_path = self.make_vpk(files)
+
+        with vpk.patch(vpk_path) as patcher:
+            for i in range(200):
+                path = "materials/long_directory_name_%d/file_%d.vmt" % (i, i)
+                files[path] = os.urandom(i)
+                patcher.add_file(path, files[path])
+            patcher.commit()
+
+        self.assert_contents(vpk_path, files)
+
+    def test_replace_and_remove(self):
+        files = {"scripts/a.txt": b"old", "scripts/b.txt": b"keep", "maps/c1m1.bsp": b"map"}
+        vpk_path = self.make_vpk(files)
+
+        with vpk.patch(vpk_path) as patcher:
+            patcher.add_file("scripts/a.txt", b"new contents")
+            patcher.remove_file("maps/c1m1.bsp")
+            patcher.commit()
+
+        files["scripts/a.txt"] = b"new contents"
+        del files["maps/c1m1.bsp"]
+        self.assert_contents(vpk_path, files)
+
+    def test_remove_pending_addition(self):
+        vpk_path = self.make_vpk({"scripts/a.txt": b"a"})
+
+        with vpk.patch(vpk_path) as patcher:
+            patcher.add_file("scripts/b.txt", b"b")
+            patcher.remove_file("scripts/b.txt")
+            self.assertRaises(KeyError, patcher.remove_file, "scripts/b.txt")
+            patcher.commit()
+
+        self.assert_contents(vpk_path, {"scripts/a.txt": b"a"})
+
+    def test_rejects_paths_without_extension(self):
+        vpk_path = self.make_vpk({"scripts/a.txt": b"a"})
+        size = os.path.getsize(vpk_path)
+
+        with vpk.patch(vpk_path) as patcher:
+            self.assertRaises(RuntimeError, patcher.add_file, "scripts/README", b"readme")
+            self.assertRaises(RuntimeError, patcher.add_file, "scripts/.txt", b"readme")
+            patcher.commit()
+
+        self.assertEqual(os.path.getsize(vpk_path), size)
+        self.assert_contents(vpk_path, {"scripts/a.txt": b"a"})
+
+    def test_failed_commit_leaves_vpk_unchanged(self):
+        vpk_path = self.make_vpk({"scripts/a.txt": b"a"})
+        with open(vpk_path, 'rb') as f:
+            original = f.read()
+
+        def broken_source():
+            raise OSError("source unavailable")
+
+        with vpk.patch(vpk_path) as patcher:
+            patcher.add_file("scripts/b.txt", b"b")
+            patcher.add_file("scripts/c.txt", broken_source)
+            self.assertRaises(OSError, patcher.commit)
+
+        with open(vpk_path, 'rb') as f:
+            self.assertEqual(f.read(), original)
+
+    def test_multi_archive(self):
+        files = {"materials/%d.vtf" % i: os.urandom(1000) for i in range(10)}
+        written = self.make_vpk(files, name="pak.vpk", max_archive_size=3000)
+        dir_path = written
+        self.assertTrue(dir_path.endswith("_dir.vpk"))
+
+        with vpk.patch(dir_path, max_archive_size=3000) as patcher:
+            files["materials/new.vtf"] = os.urandom(2500)
+            files["materials/0.vtf"] = b"replaced"
+            patcher.add_file("materials/new.vtf", files["materials/new.vtf"])
+            patcher.add_file("materials/0.vtf", files["materials/0.vtf"])
+            patcher.remove_file("materials/1.vtf")
+            del files["materials/1.vtf"]
+            patcher.commit()
+
+        self.assert_contents(dir_path, files)
+
+    def test_compact(self):
+        files = {"scripts/%d.txt" % i: os.urandom(500) for i in range(10)}
+        vpk_path = self.make_vpk(files)
+
+        with vpk.patch(vpk_path) as patcher:
+            for i in range(5):
+                patcher.remove_file("scripts/%d.txt" % i)
+                del files["scripts/%d.txt" % i]
+            files["scripts/9.txt"] = b"replaced"
+            patcher.add_file("scripts/9.txt", files["scripts/9.txt"])
+            patcher.commit()
+            patched_size = os.path.getsize(vpk_path)
+
+            patcher.compact()
+
+        self.assertLess(os.path.getsize(vpk_path), patched_size)
+        self.assert_contents(vpk_path, files)
+
+    def test_compact_multi_archive(self):
+        files = {"materials/%d.vtf" % i: os.urandom(1000) for i in range(10)}
+        dir_path = self.make_vpk(files, max_archive_size=3000)
+
+        with vpk.patch(dir_path, max_archive_size=3000) as patcher:
+            for i in range(6):
+                patcher.remove_file("materials/%d.vtf" % i)
+                del files["materials/%d.vtf" % i]
+            patcher.compact()
+
+        self.assert_contents(dir_path, files)
+        self.assertFalse(os.path.exists(dir_path[:-len("dir.vpk")] + "002.vpk"))
+
+
+if __name__ == '__main__':
+    unittest.main()
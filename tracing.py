@@ -0,0 +1,256 @@
+"""
+Lightweight tracing spans, saved as Chrome trace JSON, and per-stage
+resource accounting
+
+Open the file in chrome://tracing or https://ui.perfetto.dev
+
+    tracer = Tracer.from_env()
+    with tracer.span("process_vpk", vpk=path):
+        ...
+    tracer.save()
+
+Spans of a disabled tracer cost one attribute check, so they can stay in
+production code paths. A tracer given a ResourceMonitor also accounts the
+I/O of every span to the monitor, traced or not
+"""
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# path of the trace file, tracing is off when unset
+TRACE_ENV = "L4D2_MAP_TOOLS_TRACE"
+# path of the resource report JSON, not written when unset
+REPORT_ENV = "L4D2_MAP_TOOLS_REPORT"
+
+
+class Tracer(object):
+    """
+    Collects complete ("X") events of named spans, from any thread
+    """
+    def __init__(self, path=None, enabled=True, monitor=None):
+        self.path = path
+        self.enabled = enabled
+        self.monitor = monitor
+        self.events = []
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._pid = os.getpid()
+        self._origin = time.perf_counter_ns()
+
+    @classmethod
+    def from_env(cls, monitor=None):
+        """
+        Returns a tracer writing to the path in L4D2_MAP_TOOLS_TRACE, disabled when unset
+        """
+        path = os.environ.get(TRACE_ENV)
+        return cls(path, enabled=bool(path), monitor=monitor)
+
+    def _now(self):
+        # trace timestamps are in microseconds
+        return (time.perf_counter_ns() - self._origin) / 1000.0
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Records the duration of the with block as a span, args are shown in
+        the span details
+        """
+        if self.monitor is not None:
+            with self.monitor.stage(name), self._span(name, args):
+                yield
+        else:
+            with self._span(name, args):
+                yield
+
+    @contextmanager
+    def _span(self, name, args):
+        if not self.enabled:
+            yield
+            return
+
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.add_event(name, start, self._now() - start, args)
+
+    def add_event(self, name, start, duration, args=None):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start,
+            "dur": duration,
+            "pid": self._pid,
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    def to_dict(self):
+        with self._lock:
+            names = [{"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                     for tid, name in self._threads.items()]
+            return {"traceEvents": names + list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self, path=None):
+        """
+        Writes the trace to path (default: self.path), returns the path
+        written or None when there is nothing to write
+        """
+        path = path or self.path
+        if not self.enabled or not path:
+            return None
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+
+        return path
+
+
+def _tree_size(path):
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += _tree_size(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+def _path_size(path):
+    """
+    Returns the total size of the files under path, or the size of path
+    itself when it is a file, 0 when it does not exist
+    """
+    if os.path.isdir(path):
+        return _tree_size(path)
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class ResourceMonitor(object):
+    """
+    Accounts the bytes read and written by this process per stage, and
+    samples the peak RSS and the peak total size of temp_dirs (directories
+    or single files) every interval seconds between start and stop
+
+    I/O counters are process-wide, nested stages are included in their
+    parents and the job totals are measured between start and stop
+    """
+    def __init__(self, temp_dirs=(), interval=1.0):
+        # only needed for resource accounting
+        import psutil
+
+        self.process = psutil.Process()
+        self.temp_dirs = list(temp_dirs)
+        self.interval = interval
+        self.stages = {}
+        self.peak_rss = 0
+        self.peak_temp_bytes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self._totals = None
+
+    def _io(self):
+        """
+        Returns (bytes read, bytes written), counting reads served from the
+        OS cache where the platform reports them (read_chars on Linux)
+        """
+        try:
+            counters = self.process.io_counters()
+        except (AttributeError, NotImplementedError, OSError):
+            return 0, 0
+        return (getattr(counters, 'read_chars', counters.read_bytes),
+                getattr(counters, 'write_chars', counters.write_bytes))
+
+    def sample(self):
+        try:
+            rss = self.process.memory_info().rss
+        except OSError:
+            rss = 0
+        temp_bytes = sum(_path_size(path) for path in self.temp_dirs)
+
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            self.peak_temp_bytes = max(self.peak_temp_bytes, temp_bytes)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._stop.clear()
+        self._started = (time.perf_counter(), self._io())
+        self._totals = None
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name="ResourceMonitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.sample()
+
+        start, (read_start, write_start) = self._started
+        read_end, write_end = self._io()
+        self._totals = {
+            "seconds": time.perf_counter() - start,
+            "read_bytes": read_end - read_start,
+            "write_bytes": write_end - write_start,
+        }
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Adds the duration and I/O of the with block to the named stage
+        """
+        start = time.perf_counter()
+        read_start, write_start = self._io()
+        try:
+            yield
+        finally:
+            read_end, write_end = self._io()
+            self.sample()
+
+            with self._lock:
+                stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "read_bytes": 0, "write_bytes": 0})
+                stage["count"] += 1
+                stage["seconds"] += time.perf_counter() - start
+                stage["read_bytes"] += read_end - read_start
+                stage["write_bytes"] += write_end - write_start
+
+    def report(self):
+        with self._lock:
+            report = {
+                "peak_rss": self.peak_rss,
+                "peak_temp_bytes": self.peak_temp_bytes,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+            }
+        report.update(self._totals or {})
+        return report
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+        return path